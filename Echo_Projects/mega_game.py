@@ -1,28 +1,27 @@
-import pygame, random, json, os, math
+import pygame, random, json, os, gc, re, math, time, struct, zlib, argparse, tempfile, threading, sys
+import numpy as np
+from collections import OrderedDict, namedtuple
 
 # ================= SETTINGS =================
-pygame.init()
 WIDTH, HEIGHT = 900, 600
-screen = pygame.display.set_mode((WIDTH, HEIGHT))
-pygame.display.set_caption("MEGA SINGLE FILE RPG")
-clock = pygame.time.Clock()
-FONT = pygame.font.SysFont(None, 22)
-
 TILE = 40
 FPS = 60
+DT = 1 / FPS  # fixed simulation step; frames draw between the last two steps
+MAX_FRAME = 0.25  # longest frame the loop catches up on, so one stall can't snowball
+
+BENCH_TICKS = 20000
+BENCH_ENEMIES = 3000
+BENCH_BULLETS = 3000
+BENCH_FRAMES = 600
+BENCH_MAP = 2000  # tiles per side of the generated map for the draw benchmark
+BENCH_SAVE_ENEMIES = 200000
+BENCH_SAVE_BULLETS = 20000
 
 # Colors
 WHITE=(255,255,255); BLACK=(0,0,0); RED=(255,0,0)
 GREEN=(0,255,0); BLUE=(0,0,255); GRAY=(120,120,120)
 YELLOW=(255,255,0)
 
-# ================= CONTROLLER =================
-if pygame.joystick.get_count():
-    joystick = pygame.joystick.Joystick(0)
-    joystick.init()
-else:
-    joystick = None
-
 # ================= MAP =================
 MAP = [
 "11111111111111111111",
@@ -33,55 +32,496 @@ MAP = [
 "10000000000000000001",
 "11111111111111111111"
 ]
-
-WORLD_W = len(MAP[0]) * TILE
-WORLD_H = len(MAP) * TILE
+map_version = 0  # bumped on every change to MAP
+
+def walkable(x, y):
+    return 0<=y<len(MAP) and 0<=x<len(MAP[0]) and MAP[y][x]!="1"
+
+# ================= TILEMAP CHUNKS =================
+CHUNK = 16  # tiles per chunk side
+CHUNK_CACHE = 24  # pre-rendered chunks kept; a 900x600 view touches at most 6
+WALLS = re.compile("1+")
+
+chunks = OrderedDict()  # (cx,cy) -> Surface, least recently drawn first
+
+def build_chunk(cx, cy):
+    """Render CHUNK x CHUNK tiles once: floor fill plus one rect per horizontal run of wall."""
+    x0,y0=cx*CHUNK,cy*CHUNK
+    rows=MAP[y0:y0+CHUNK]
+    w=min(CHUNK,len(MAP[0])-x0)
+    surf=pygame.Surface((w*TILE,len(rows)*TILE)).convert()
+    surf.fill(GRAY)
+    for y,row in enumerate(rows):
+        for run in WALLS.finditer(row,x0,x0+w):
+            pygame.draw.rect(surf,BLACK,((run.start()-x0)*TILE,y*TILE,(run.end()-run.start())*TILE,TILE))
+    return surf
+
+def draw_map(camx, camy):
+    """One blit per chunk on screen; chunks are built when first seen and evicted least recently drawn."""
+    span=CHUNK*TILE
+    cols=(len(MAP[0])+CHUNK-1)//CHUNK
+    rows=(len(MAP)+CHUNK-1)//CHUNK
+    for cy in range(max(0,camy//span), min(rows,(camy+HEIGHT-1)//span+1)):
+        for cx in range(max(0,camx//span), min(cols,(camx+WIDTH-1)//span+1)):
+            surf=chunks.get((cx,cy))
+            if surf is None:
+                surf=chunks[(cx,cy)]=build_chunk(cx,cy)
+                if len(chunks)>CHUNK_CACHE: chunks.popitem(last=False)
+            else:
+                chunks.move_to_end((cx,cy))
+            screen.blit(surf,(cx*span-camx,cy*span-camy))
+
+def set_tile(x, y, t):
+    """Change one tile and drop its chunk so it is re-rendered on the next draw."""
+    global map_version
+    MAP[y]=MAP[y][:x]+t+MAP[y][x+1:]
+    chunks.pop((x//CHUNK,y//CHUNK),None)
+    map_version+=1
 
 # ================= PLAYER =================
-player = pygame.Rect(200, 200, 30, 30)
-speed = 5
-hp = 100
-max_hp = 100
-xp = 0
-level = 1
-damage = 10
-
-# ================= INVENTORY =================
-inventory = {"Potion": 2}
+PLAYER_SPEED = 300  # pixels per second
+CONTACT_DPS = 60  # hp per second lost to each touching enemy
 
 # ================= NPC =================
-npc = pygame.Rect(300, 200, 30, 30)
-dialogue = ["Welcome hero!", "Enemies hunt in squads.", "Defeat them all!"]
-dlg_index = 0
-show_dlg = False
+DIALOGUE = ["Welcome hero!", "Enemies hunt in squads.", "Defeat them all!"]
 
 # ================= ENEMIES (SQUADS) =================
-enemies = []
-for i in range(6):
-    enemies.append({
-        "rect": pygame.Rect(500+i*40, 400, 30, 30),
-        "hp": 40
-    })
+ENEMY_SIZE = 30
+ENEMY_HP = 40
+ENEMY_SPEED = 60  # pixels per second
+AGGRO = 300  # chase radius in pixels
+
+class Squad:
+    """All enemies as parallel NumPy arrays (structure of arrays); row i of each array is enemy i.
+    Only the first n rows are live; dead enemies are flagged in `alive` and packed out by compact()."""
+    def __init__(self, capacity=64):
+        self.n=0
+        self.pos=np.zeros((capacity,2))  # top-left corner, float pixels
+        self.prev=np.zeros((capacity,2))  # pos before the last step, for render interpolation
+        self.vel=np.zeros((capacity,2))
+        self.hp=np.zeros(capacity)
+        self.alive=np.zeros(capacity,bool)
+
+    def __len__(self):
+        return self.n
+
+    def spawn(self, x, y, hp=ENEMY_HP):
+        if self.n==len(self.hp):
+            self._grow(2*self.n)
+        i=self.n; self.n+=1
+        self.pos[i]=self.prev[i]=x,y; self.vel[i]=0; self.hp[i]=hp; self.alive[i]=True
+
+    def _grow(self, capacity):
+        for name in ("pos","prev","vel","hp","alive"):
+            old=getattr(self,name)
+            new=np.zeros((capacity,)+old.shape[1:],old.dtype)
+            new[:self.n]=old[:self.n]
+            setattr(self,name,new)
+
+    def compact(self):
+        """Pack the live enemies into the first rows; returns how many were removed."""
+        keep=self.alive[:self.n]
+        k=int(keep.sum())
+        if k<self.n:
+            for a in (self.pos,self.prev,self.vel,self.hp,self.alive):
+                a[:k]=a[:self.n][keep]
+        removed=self.n-k; self.n=k
+        return removed
+
+    def clear(self):
+        self.n=0
+
+    def load(self, pos, hp):
+        """Replace the squad with len(hp) live enemies in one go (the saved game path)."""
+        n=len(hp)
+        self._grow(max(64,n)); self.n=n
+        self.pos[:n]=self.prev[:n]=pos; self.vel[:n]=0; self.hp[:n]=hp; self.alive[:n]=True
 
 # ================= BULLETS =================
-bullets = []
+BULLET_SIZE = 6
+BULLET_SPEED = 600  # pixels per second, straight up
+
+# ================= FLOW FIELD =================
+FLOW_RADIUS = 2*AGGRO//TILE  # longest path searched, in tiles; enemies further along it wait
+
+class FlowField:
+    """BFS from the player's tile over walkable MAP cells, up to FLOW_RADIUS steps. Every reached cell
+    stores the pixel centre of the next cell on a shortest path to the player, so each enemy's heading
+    is one array lookup. The window around the player keeps the cost independent of map size and of
+    how many enemies read it; it is only recomputed when the player changes tile or the map changes."""
+    def __init__(self, radius=FLOW_RADIUS):
+        self.radius=radius
+        self.origin=None
+        self.version=None
+        size=2*radius+1
+        self.next=np.zeros((size,size,2))
+        self.reached=np.zeros((size,size),bool)
+
+    def update(self, tx, ty):
+        if (tx,ty)==self.origin and self.version==map_version: return
+        self.origin=(tx,ty); self.version=map_version
+        r=self.radius; x0,y0=tx-r,ty-r
+        reached=self.reached; nxt=self.next
+        reached[:]=False
+        if not walkable(tx,ty): return
+        reached[r,r]=True; nxt[r,r]=(tx+0.5)*TILE,(ty+0.5)*TILE
+        frontier=[(tx,ty)]
+        for _ in range(r):
+            ahead=[]
+            for x,y in frontier:
+                for nx,ny in ((x+1,y),(x-1,y),(x,y+1),(x,y-1)):
+                    lx,ly=nx-x0,ny-y0
+                    if 0<=lx<=2*r and 0<=ly<=2*r and not reached[ly,lx] and walkable(nx,ny):
+                        reached[ly,lx]=True
+                        nxt[ly,lx]=(x+0.5)*TILE,(y+0.5)*TILE
+                        ahead.append((nx,ny))
+            frontier=ahead
+
+    def lookup(self, centers):
+        """Next waypoint for each pixel centre (an (n,2) array), and a mask of the ones the field covers."""
+        r=self.radius; tx,ty=self.origin
+        cells=np.floor_divide(centers,TILE).astype(np.intp)-(tx-r,ty-r)
+        ok=((cells>=0)&(cells<=2*r)).all(1)
+        ok[ok]=self.reached[cells[ok,1],cells[ok,0]]
+        targets=np.zeros_like(centers)
+        targets[ok]=self.next[cells[ok,1],cells[ok,0]]
+        return targets,ok
+
+# ================= COLLISIONS =================
+class SpatialHash:
+    """Broad phase: a uniform grid of TILE cells, built from an array of top-left corners. Each item is
+    binned once, by the cell of its corner, and items are sorted by cell so every cell is one slice;
+    queries reach back by the item size so nothing that overlaps is missed."""
+    OFFSET = 1<<20  # keeps cell coordinates of off-map positions non-negative in the key
+
+    def __init__(self, cell=TILE):
+        self.cell=cell
+        self.keys=np.zeros(0,np.int64)
+        self.order=np.zeros(0,np.intp)
+        self.size=0
+
+    def _key(self, cx, cy):
+        return (cx+self.OFFSET)*(self.OFFSET*2)+(cy+self.OFFSET)
+
+    def build(self, xy, size):
+        """Bin items with top-left corners xy (an (n,2) array), each size x size."""
+        cells=np.floor_divide(xy,self.cell).astype(np.int64)
+        keys=self._key(cells[:,0],cells[:,1])
+        self.order=np.argsort(keys,kind="stable")
+        self.keys=keys[self.order]
+        self.size=size
+
+    def pairs(self, xy, size):
+        """(query index, item index) arrays for every item binned in a cell that a size x size rect at each
+        row of xy could overlap. Candidates only: the exact test is left to the caller."""
+        c=self.cell
+        lo=np.floor_divide(xy-self.size,c).astype(np.int64)
+        hi=np.floor_divide(xy+size,c).astype(np.int64)  # corners are floats, so no -1 as for int rects
+        span=int((size+self.size)//c)+2  # most cells a query can cover per axis
+        queries=np.arange(len(xy))
+        qs=[]; items=[]
+        for ox in range(span):
+            for oy in range(span):
+                cx=lo[:,0]+ox; cy=lo[:,1]+oy
+                ok=(cx<=hi[:,0])&(cy<=hi[:,1])
+                key=self._key(cx[ok],cy[ok])
+                start=np.searchsorted(self.keys,key,"left")
+                count=np.searchsorted(self.keys,key,"right")-start
+                total=int(count.sum())
+                if not total: continue
+                # expand each query's [start, start+count) slice into one row per candidate
+                first=np.repeat(start-np.cumsum(count)+count,count)
+                qs.append(np.repeat(queries[ok],count))
+                items.append(self.order[first+np.arange(total)])
+        if not qs:
+            return np.zeros(0,np.intp),np.zeros(0,np.intp)
+        return np.concatenate(qs),np.concatenate(items)
+
+def overlaps(axy, asize, bxy, bsize):
+    """Row-wise Rect.colliderect for squares with top-left corners axy and bxy."""
+    return ((axy[:,0]<bxy[:,0]+bsize)&(bxy[:,0]<axy[:,0]+asize)&
+            (axy[:,1]<bxy[:,1]+bsize)&(bxy[:,1]<axy[:,1]+asize))
+
+def swap_remove(items, dead):
+    """Drop the given indices in O(len(dead)): each is overwritten by the current last item (order is not kept)."""
+    for i in sorted(dead, reverse=True):
+        items[i]=items[-1]; items.pop()
+
+# ================= SIMULATION =================
+Inputs = namedtuple("Inputs", "dx dy shoot talk heal")  # one tick: held direction, plus presses this tick
+IDLE = Inputs(0, 0, False, False, False)
+
+class Game:
+    """The whole simulation state, advanced only by step(). No display or event calls in here, so it
+    runs headless at whatever speed the caller drives it. Anything random in the world draws from
+    self.rng, so a seed plus the inputs of every tick reproduce a session exactly."""
+    def __init__(self, seed=None):
+        self.seed=random.randrange(1<<32) if seed is None else seed
+        self.rng=random.Random(self.seed)
+        self.player=pygame.Rect(200,200,30,30)
+        self.prev=self.player.topleft  # player position before the last step
+        self.hp=100; self.max_hp=100
+        self.xp=0; self.level=1; self.damage=10
+        self.inventory={"Potion": 2}
+        self.npc=pygame.Rect(300,200,30,30)
+        self.dlg_index=0; self.show_dlg=False
+        self.enemies=Squad()
+        for i in range(6):
+            self.enemies.spawn(500+i*40, 205)  # on the open row 5; squads path over walkable tiles only
+        self.bullets=[]
+        self.grid=SpatialHash()
+        self.flow=FlowField()
+        self.ticks=0
+
+    def step(self, dt, inputs):
+        """Advance the world by dt seconds under one tick of inputs."""
+        self.ticks+=1
+        p=self.player
+        if inputs.shoot:
+            self.bullets.append(pygame.Rect(p.centerx,p.centery,BULLET_SIZE,BULLET_SIZE))
+        if inputs.talk and p.colliderect(self.npc):
+            self.show_dlg=True; self.dlg_index=(self.dlg_index+1)%len(DIALOGUE)
+        if inputs.heal and self.inventory.get("Potion",0)>0:
+            self.hp=min(self.max_hp,self.hp+30); self.inventory["Potion"]-=1
+
+        self.prev=p.topleft
+        p.x+=inputs.dx*PLAYER_SPEED*dt; p.y+=inputs.dy*PLAYER_SPEED*dt
+        p.clamp_ip(pygame.Rect(0,0,len(MAP[0])*TILE,len(MAP)*TILE))
+
+        self.update_combat(dt)
+
+        if self.xp>=self.level*50:
+            self.level+=1; self.damage+=5; self.max_hp+=20; self.hp=self.max_hp
+
+    def update_combat(self, dt):
+        """Move bullets, then chase, contact damage, bullet hits and deaths for the whole squad at once."""
+        player=self.player; enemies=self.enemies; bullets=self.bullets; flow=self.flow
+        gone=set()  # bullet indices
+        rise=round(BULLET_SPEED*dt)
+        for i,b in enumerate(bullets):
+            b.y-=rise
+            if b.y<0: gone.add(i)
+
+        n=enemies.n
+        if n:
+            pos=enemies.pos[:n]; vel=enemies.vel[:n]; ehp=enemies.hp[:n]
+            enemies.prev[:n]=pos
+            # Chase inside the aggro radius: head for the next waypoint of the flow field, or straight
+            # at the player once in the player's tile; stand still outside it or where the field can't reach
+            you=np.array(player.center,float)
+            centers=pos+ENEMY_SIZE/2
+            dist=np.hypot(*(you-centers).T)
+            flow.update(player.centerx//TILE,player.centery//TILE)
+            target,chase=flow.lookup(centers)
+            home=(np.floor_divide(centers,TILE)==flow.origin).all(1)
+            target[home]=you
+            to=target-centers
+            step=np.hypot(*to.T)
+            chase&=(dist<AGGRO)&(step>0)
+            vel[:]=0
+            vel[chase]=to[chase]/step[chase,None]*ENEMY_SPEED
+            pos+=vel*dt
+
+            self.hp-=CONTACT_DPS*dt*int(overlaps(pos,ENEMY_SIZE,np.array([player.topleft],float),player.w).sum())
+
+            if bullets:
+                bxy=np.array([b.topleft for b in bullets],float)
+                self.grid.build(bxy,BULLET_SIZE)
+                e,j=self.grid.pairs(pos,ENEMY_SIZE)
+                hit=overlaps(pos[e],ENEMY_SIZE,bxy[j],BULLET_SIZE)
+                if gone:
+                    hit&=~np.isin(j,list(gone))
+                e,j=e[hit],j[hit]
+                # a bullet is spent on the first enemy (lowest index) it overlaps
+                first=np.lexsort((e,j))
+                j,idx=np.unique(j[first],return_index=True)
+                e=e[first][idx]
+                ehp-=np.bincount(e,minlength=n)*self.damage
+                gone.update(j.tolist())
+
+            enemies.alive[:n]=ehp>0
+            self.xp+=10*enemies.compact()
+        swap_remove(bullets,gone)
 
 # ================= SAVE / LOAD =================
-def save_game():
-    data = {"hp": hp, "xp": xp, "lvl": level, "inv": inventory}
-    with open("save.json","w") as f:
-        json.dump(data,f)
-
-def load_game():
-    global hp, xp, level, inventory
-    if os.path.exists("save.json"):
-        with open("save.json") as f:
-            d=json.load(f)
-            hp=d["hp"]; xp=d["xp"]; level=d["lvl"]; inventory=d["inv"]
+def stats(game):
+    return {"hp": game.hp, "xp": game.xp, "lvl": game.level, "inv": game.inventory}
+
+def apply_stats(game, d):
+    game.hp=d["hp"]; game.xp=d["xp"]; game.level=d["lvl"]; game.inventory=dict(d["inv"])
+
+SAVE_FILE = "save.dat"
+LEGACY_SAVE = "save.json"  # stats only; still read when there is no SAVE_FILE
+SAVE_MAGIC = b"MGSV"
+SAVE_VERSION = 1
+SAVE_HEADER = struct.Struct("<4sHIIII")  # magic, version, crc32 of the body, meta length, enemies, bullets
+AUTOSAVE_SECONDS = 30
+
+def snapshot(game):
+    """Copy everything a save needs, on the game thread. The arrays are plain memcpys of the live rows,
+    so this stays cheap for big squads; encoding and disk I/O then work on the copy, not the world."""
+    n=game.enemies.n
+    meta=dict(stats(game), max_hp=game.max_hp, dmg=game.damage, player=game.player.topleft,
+              dlg=game.dlg_index, show_dlg=game.show_dlg, ticks=game.ticks, seed=game.seed)
+    return (meta, game.enemies.pos[:n].astype("<f8"), game.enemies.hp[:n].astype("<f8"),
+            np.array([b.topleft for b in game.bullets],"<i4").reshape(-1,2))
+
+def encode_save(snap):
+    """Header plus one zlib body: meta JSON, enemy positions and hp, bullet corners."""
+    meta,pos,hp,bullets=snap
+    meta=json.dumps(meta).encode()
+    body=zlib.compress(b"".join((meta,pos.tobytes(),hp.tobytes(),bullets.tobytes())),1)
+    return SAVE_HEADER.pack(SAVE_MAGIC,SAVE_VERSION,zlib.crc32(body),len(meta),len(hp),len(bullets))+body
+
+def write_save(path, snap):
+    """Written to a temp file next to path and renamed over it, so a crash leaves either the old save
+    or the new one."""
+    tmp=path+".tmp"
+    with open(tmp,"wb") as f:
+        f.write(encode_save(snap))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp,path)
+
+def read_save(path, game):
+    with open(path,"rb") as f:
+        decode_save(f.read(),game,path)
+
+def decode_save(data, game, name="save"):
+    """Restore game from encode_save() bytes; name is only used in errors."""
+    magic,version,crc,meta_len,n,nb=SAVE_HEADER.unpack_from(data)
+    if magic!=SAVE_MAGIC:
+        raise ValueError(f"{name}: not a save file")
+    if version>SAVE_VERSION:
+        raise ValueError(f"{name}: saved by a newer version ({version})")
+    body=data[SAVE_HEADER.size:]
+    if zlib.crc32(body)!=crc:
+        raise ValueError(f"{name}: corrupt save")
+    body=zlib.decompress(body)
+    meta=json.loads(body[:meta_len])
+    at=meta_len
+    pos=np.frombuffer(body,"<f8",n*2,at).reshape(n,2); at+=pos.nbytes
+    hp=np.frombuffer(body,"<f8",n,at); at+=hp.nbytes
+    bullets=np.frombuffer(body,"<i4",nb*2,at).reshape(nb,2)
+
+    apply_stats(game,meta)
+    game.max_hp=meta["max_hp"]; game.damage=meta["dmg"]
+    game.player.topleft=meta["player"]; game.prev=game.player.topleft
+    game.dlg_index=meta["dlg"]; game.show_dlg=meta["show_dlg"]
+    game.ticks=meta["ticks"]; game.seed=meta["seed"]; game.rng=random.Random(game.seed)
+    game.enemies.load(pos,hp)
+    game.bullets=[pygame.Rect(x,y,BULLET_SIZE,BULLET_SIZE) for x,y in bullets.tolist()]
+
+def save_game(game, path=SAVE_FILE):
+    write_save(path,snapshot(game))
+
+def load_game(game, path=SAVE_FILE):
+    if os.path.exists(path):
+        read_save(path,game)
+    elif os.path.exists(LEGACY_SAVE):
+        with open(LEGACY_SAVE) as f:
+            apply_stats(game,json.load(f))
+
+class Autosaver:
+    """Every `interval` seconds the game loop hands a snapshot to a daemon thread, which writes it.
+    Only the newest snapshot waits: if a write is still running, a later one replaces the queued one.
+    Nothing is taken while the world hasn't advanced (paused, or no steps since the last save)."""
+    def __init__(self, path=SAVE_FILE, interval=AUTOSAVE_SECONDS):
+        self.path=path; self.interval=interval
+        self.pending=None; self.closing=False
+        self.saved_tick=None; self.due=time.monotonic()+interval
+        self.cv=threading.Condition()
+        self.thread=threading.Thread(target=self._run,name="autosave",daemon=True)
+        self.thread.start()
+
+    def tick(self, game):
+        if time.monotonic()<self.due: return
+        self.due=time.monotonic()+self.interval
+        self.submit(game)
+
+    def submit(self, game):
+        if game.ticks==self.saved_tick: return
+        self.saved_tick=game.ticks
+        snap=snapshot(game)
+        with self.cv:
+            self.pending=snap; self.cv.notify()
+
+    def _run(self):
+        while True:
+            with self.cv:
+                while self.pending is None and not self.closing: self.cv.wait()
+                snap,self.pending=self.pending,None
+                if snap is None: return
+            try: write_save(self.path,snap)
+            except OSError as e:  # keep saving: the next snapshot may well get through (disk freed, ...)
+                print(f"autosave to {self.path} failed: {e}",file=sys.stderr)
+
+    def close(self, game=None):
+        """Stop the thread once queued writes are done; with game, save it one last time first."""
+        if game is not None: self.submit(game)
+        with self.cv:
+            self.closing=True; self.cv.notify()
+        self.thread.join()
+
+# ================= RECORD / REPLAY =================
+REPLAY_MAGIC = b"MGRP"
+REPLAY_VERSION = 2
+REPLAY_HEADER = struct.Struct("<4sHQI")  # magic, version, seed, length of the starting world (a save)
+REPLAY_TICK = struct.Struct("<ddB")  # dx, dy, presses: 1 shoot, 2 talk, 4 heal
+REPLAY_FLUSH = FPS  # ticks between sync flushes; a crash loses at most this many
+
+class Recorder:
+    """Logs the inputs of every simulation step after a header with the seed and the whole starting
+    world, encoded as a save. Ticks stream through zlib, so held keys and idle stretches cost next to
+    nothing on disk."""
+    def __init__(self, path, game):
+        self.f=open(path,"wb")
+        start=encode_save(snapshot(game))
+        self.f.write(REPLAY_HEADER.pack(REPLAY_MAGIC,REPLAY_VERSION,game.seed,len(start))+start)
+        self.z=zlib.compressobj(9)
+        self.ticks=0
+
+    def log(self, inputs):
+        presses=inputs.shoot|inputs.talk<<1|inputs.heal<<2
+        self.f.write(self.z.compress(REPLAY_TICK.pack(inputs.dx,inputs.dy,presses)))
+        self.ticks+=1
+        if self.ticks%REPLAY_FLUSH==0:
+            self.f.write(self.z.flush(zlib.Z_SYNC_FLUSH))
+
+    def close(self):
+        self.f.write(self.z.flush())
+        self.f.close()
+
+def read_replay(path):
+    """(seed, starting world as save bytes, list of Inputs) from a Recorder file; a cut-off tail is dropped."""
+    with open(path,"rb") as f:
+        data=f.read()
+    magic,version,seed,n=REPLAY_HEADER.unpack_from(data)
+    if magic!=REPLAY_MAGIC or version!=REPLAY_VERSION:
+        raise ValueError(f"{path}: not a version {REPLAY_VERSION} replay")
+    at=REPLAY_HEADER.size
+    start=data[at:at+n]
+    ticks=zlib.decompressobj().decompress(data[at+n:])
+    ticks=ticks[:len(ticks)-len(ticks)%REPLAY_TICK.size]
+    return seed,start,[Inputs(dx,dy,bool(p&1),bool(p&2),bool(p&4)) for dx,dy,p in REPLAY_TICK.iter_unpack(ticks)]
+
+# ================= DISPLAY =================
+screen = None
+clock = None
+FONT = None
+joystick = None
+
+def open_display():
+    global screen, clock, FONT, joystick
+    pygame.init()
+    screen = pygame.display.set_mode((WIDTH, HEIGHT))
+    pygame.display.set_caption("MEGA SINGLE FILE RPG")
+    clock = pygame.time.Clock()
+    FONT = pygame.font.SysFont(None, 22)
+    if pygame.joystick.get_count():
+        joystick = pygame.joystick.Joystick(0)
+        joystick.init()
 
-load_game()
-
-# ================= FUNCTIONS =================
 def draw_text(t,x,y,c=WHITE):
     screen.blit(FONT.render(t,1,c),(x,y))
 
@@ -98,108 +538,260 @@ def get_input():
         dy=joystick.get_axis(1)
     return dx,dy
 
-# ================= GAME LOOP =================
-paused=False
-running=True
-while running:
-    clock.tick(FPS)
-    for e in pygame.event.get():
-        if e.type==pygame.QUIT:
-            save_game(); running=False
-        if e.type==pygame.KEYDOWN:
-            if e.key==pygame.K_p: paused=not paused
-            if e.key==pygame.K_SPACE:
-                bullets.append(pygame.Rect(player.centerx,player.centery,6,6))
-            if e.key==pygame.K_e and player.colliderect(npc):
-                show_dlg=True; dlg_index=(dlg_index+1)%len(dialogue)
-            if e.key==pygame.K_h and inventory.get("Potion",0)>0:
-                hp=min(max_hp,hp+30); inventory["Potion"]-=1
-
-    if paused:
-        screen.fill(BLACK)
-        draw_text("PAUSED",WIDTH//2-40,HEIGHT//2)
-        pygame.display.update(); continue
-
-    # Movement
-    dx,dy=get_input()
-    player.x+=dx*speed; player.y+=dy*speed
-    player.clamp_ip(pygame.Rect(0,0,WORLD_W,WORLD_H))
-
-    camx=player.x-WIDTH//2
-    camy=player.y-HEIGHT//2
-
-    # Bullets
-    for b in bullets[:]:
-        b.y-=10
-        if b.y<0: bullets.remove(b)
-
-    # Enemy Squad AI
-    for i,en in enumerate(enemies[:]):
-        dist=math.hypot(player.x-en["rect"].x,player.y-en["rect"].y)
-        if dist<300:
-            angle=math.atan2(player.y-en["rect"].y,player.x-en["rect"].x)
-            en["rect"].x+=math.cos(angle)
-            en["rect"].y+=math.sin(angle)
-
-        if en["rect"].colliderect(player):
-            hp-=1
-
-        for b in bullets[:]:
-            if en["rect"].colliderect(b):
-                en["hp"]-=damage; bullets.remove(b)
-
-        if en["hp"]<=0:
-            enemies.remove(en); xp+=10
-
-    # Level up
-    if xp>=level*50:
-        level+=1; damage+=5; max_hp+=20; hp=max_hp
-
-    # Death
-    if hp<=0:
-        screen.fill(BLACK)
-        draw_text("YOU DIED",WIDTH//2-40,HEIGHT//2,RED)
-        pygame.display.update()
-        pygame.time.delay(3000)
-        break
+def draw(game, alpha):
+    """Draw the world alpha (0..1) of the way from the previous step to the current one."""
+    p=game.player
+    px=game.prev[0]+(p.x-game.prev[0])*alpha
+    py=game.prev[1]+(p.y-game.prev[1])*alpha
+    camx=int(px)-WIDTH//2
+    camy=int(py)-HEIGHT//2
 
-    # ================= DRAW =================
     screen.fill(GRAY)
 
     # Map
-    for y,row in enumerate(MAP):
-        for x,t in enumerate(row):
-            if t=="1":
-                pygame.draw.rect(screen,BLACK,
-                (x*TILE-camx,y*TILE-camy,TILE,TILE))
+    draw_map(camx,camy)
 
     # NPC
-    pygame.draw.rect(screen,GREEN,(npc.x-camx,npc.y-camy,30,30))
+    pygame.draw.rect(screen,GREEN,(game.npc.x-camx,game.npc.y-camy,30,30))
 
     # Enemies
-    for en in enemies:
-        pygame.draw.rect(screen,RED,
-        (en["rect"].x-camx,en["rect"].y-camy,30,30))
+    n=game.enemies.n
+    prev=game.enemies.prev[:n]
+    sxy=(prev+(game.enemies.pos[:n]-prev)*alpha).astype(int)-(camx,camy)
+    seen=(sxy[:,0]>-ENEMY_SIZE)&(sxy[:,0]<WIDTH)&(sxy[:,1]>-ENEMY_SIZE)&(sxy[:,1]<HEIGHT)
+    for x,y in sxy[seen].tolist():
+        pygame.draw.rect(screen,RED,(x,y,ENEMY_SIZE,ENEMY_SIZE))
 
     # Player
     pygame.draw.rect(screen,BLUE,
-    (player.x-camx,player.y-camy,30,30))
+    (int(px)-camx,int(py)-camy,30,30))
 
-    # Bullets
-    for b in bullets:
+    # Bullets, one step's rise behind where they are now
+    lag=int(BULLET_SPEED*DT*(1-alpha))
+    for b in game.bullets:
         pygame.draw.rect(screen,YELLOW,
-        (b.x-camx,b.y-camy,6,6))
+        (b.x-camx,b.y+lag-camy,BULLET_SIZE,BULLET_SIZE))
 
     # UI
-    draw_text(f"HP: {hp}",10,10)
-    draw_text(f"XP: {xp}",10,30)
-    draw_text(f"Level: {level}",10,50)
-    draw_text(f"Potions: {inventory.get('Potion',0)}",10,70)
+    draw_text(f"HP: {max(0,math.ceil(game.hp))}",10,10)
+    draw_text(f"XP: {game.xp}",10,30)
+    draw_text(f"Level: {game.level}",10,50)
+    draw_text(f"Potions: {game.inventory.get('Potion',0)}",10,70)
 
-    if show_dlg:
+    if game.show_dlg:
         pygame.draw.rect(screen,BLACK,(200,450,500,100))
-        draw_text(dialogue[dlg_index],220,480)
+        draw_text(DIALOGUE[game.dlg_index],220,480)
+
+# ================= BENCHMARK =================
+def report(name, times):
+    times=sorted(times)
+    avg=sum(times)/len(times); p99=times[int(len(times)*0.99)]
+    print(f"{name}: avg {avg*1000:.2f} ms  p99 {p99*1000:.2f} ms  ({1/avg:.0f}/s)")
+    print(f"  60 FPS budget {1000/FPS:.1f} ms: {'holds' if p99<1/FPS else 'missed'} at p99")
+
+def bench_world(tiles, rng):
+    """Replace MAP with a tiles x tiles map, one wall in ten."""
+    global map_version
+    MAP[:]=["".join(rng.choices("0000000001",k=tiles)) for _ in range(tiles)]
+    chunks.clear(); map_version+=1
+
+def bench_sim():
+    """The starting world stepped headless with random held keys and presses, as fast as it goes."""
+    rng=random.Random(1)
+    game=Game()
+    inputs=IDLE
+    start=time.perf_counter()
+    for tick in range(BENCH_TICKS):
+        if tick%30==0:
+            inputs=Inputs(rng.choice((-1,0,1)),rng.choice((-1,0,1)),False,False,False)
+        game.step(DT,inputs._replace(shoot=rng.random()<0.1,talk=rng.random()<0.02,heal=rng.random()<0.01))
+        if game.hp<=0: game=Game()
+    took=time.perf_counter()-start
+    print(f"simulation: {BENCH_TICKS} ticks in {took:.2f} s ({BENCH_TICKS/took:.0f} ticks/s, {BENCH_TICKS/took/FPS:.0f}x real time)")
+
+def bench_combat():
+    """Combat steps with thousands of enemies and bullets, the player walking through the middle."""
+    rng=random.Random(1)
+    area=int(math.sqrt(BENCH_ENEMIES))*TILE*2  # square field, about a quarter covered by enemies
+    bench_world(area//TILE,rng)
+    game=Game()
+    game.player.center=(area//2,area//2)
+    game.enemies.clear()
+    times=[]
+    for frame in range(BENCH_FRAMES):
+        while len(game.enemies)<BENCH_ENEMIES:  # keep the counts up as enemies die and bullets leave
+            game.enemies.spawn(rng.randrange(area),rng.randrange(area))
+        while len(game.bullets)<BENCH_BULLETS:
+            game.bullets.append(pygame.Rect(rng.randrange(area),rng.randrange(area),6,6))
+        if frame==0: gc.freeze()  # as after loading a level: keep the startup heap out of full collections
+        game.hp=game.max_hp
+        walk=1 if frame%200<100 else -1  # crosses a tile every 8 frames: flow field recomputes
+        start=time.perf_counter()
+        game.step(DT,IDLE._replace(dx=walk))
+        times.append(time.perf_counter()-start)
+    print(f"{BENCH_ENEMIES} enemies, {BENCH_BULLETS} bullets, {BENCH_FRAMES} frames")
+    report("step",times)
+
+def bench_map():
+    """Pan the camera diagonally across a generated BENCH_MAP x BENCH_MAP map, building chunks as they scroll in."""
+    bench_world(BENCH_MAP,random.Random(1))
+    times=[]
+    for frame in range(BENCH_FRAMES):
+        start=time.perf_counter()
+        draw_map(frame*7,frame*5)
+        times.append(time.perf_counter()-start)
+        if frame%60==0: set_tile(frame*7//TILE,frame*5//TILE,"1")  # invalidates a chunk on screen
+    print(f"{BENCH_MAP}x{BENCH_MAP} tile map, {BENCH_FRAMES} frames, {len(chunks)} chunks cached")
+    report("draw_map",times)
+
+def bench_flow():
+    """Flow field rebuilds on the BENCH_MAP map, and lookups for squads of growing size."""
+    rng=random.Random(1)
+    flow=FlowField()
+    times=[]
+    for _ in range(BENCH_FRAMES):
+        tx,ty=rng.randrange(BENCH_MAP),rng.randrange(BENCH_MAP)
+        start=time.perf_counter()
+        flow.update(tx,ty)
+        times.append(time.perf_counter()-start)
+    print(f"flow field, radius {FLOW_RADIUS} tiles on the {BENCH_MAP}x{BENCH_MAP} map")
+    report("rebuild",times)
+    tx,ty=flow.origin
+    for n in (1000,10000,100000):
+        centers=np.random.default_rng(1).uniform(-AGGRO,AGGRO,(n,2))+((tx+0.5)*TILE,(ty+0.5)*TILE)
+        start=time.perf_counter()
+        for _ in range(100): flow.lookup(centers)
+        print(f"  lookup for {n} enemies: {(time.perf_counter()-start)*10:.3f} ms")
+
+def bench_save():
+    """Snapshot, write and load a world with BENCH_SAVE_ENEMIES enemies and BENCH_SAVE_BULLETS bullets."""
+    rng=np.random.default_rng(1)
+    game=Game()
+    game.enemies.load(rng.uniform(0,50000,(BENCH_SAVE_ENEMIES,2)),rng.integers(1,ENEMY_HP,BENCH_SAVE_ENEMIES))
+    game.bullets=[pygame.Rect(x,y,BULLET_SIZE,BULLET_SIZE) for x,y in rng.integers(0,50000,(BENCH_SAVE_BULLETS,2)).tolist()]
+    path=os.path.join(tempfile.mkdtemp(),SAVE_FILE)
+    start=time.perf_counter(); snap=snapshot(game)
+    snapped=time.perf_counter(); write_save(path,snap)
+    written=time.perf_counter(); loaded=Game(); load_game(loaded,path)
+    done=time.perf_counter()
+    same=np.array_equal(loaded.enemies.pos[:loaded.enemies.n],game.enemies.pos[:game.enemies.n])
+    print(f"save: {BENCH_SAVE_ENEMIES} enemies, {BENCH_SAVE_BULLETS} bullets, {os.path.getsize(path)/1e6:.1f} MB on disk")
+    print(f"  snapshot {(snapped-start)*1000:.1f} ms (game thread)  write {(written-snapped)*1000:.1f} ms (autosave thread)"
+          f"  load {(done-written)*1000:.1f} ms  round trip {'ok' if same else 'MISMATCH'}")
+    os.remove(path); os.rmdir(os.path.dirname(path))
+
+def benchmark():
+    """python mega_game.py --bench: everything headless on the SDL dummy driver, no window."""
+    os.environ.setdefault("SDL_VIDEODRIVER","dummy")
+    open_display()
+    bench_sim()
+    bench_combat()
+    bench_map()
+    bench_flow()
+    bench_save()
+    pygame.quit()
+
+def replay(path, render=False, trace=None):
+    """Re-run a recorded session: headless as fast as it goes, or drawn one step per frame at FPS.
+    Prints step (and draw) timings; trace writes them per tick as CSV."""
+    seed,start,ticks=read_replay(path)
+    game=Game(seed)
+    decode_save(start,game,path)
+    if render: open_display()
+    steps=[]; draws=[]
+    began=time.perf_counter()
+    for inputs in ticks:
+        if render and pygame.event.peek(pygame.QUIT): break
+        t0=time.perf_counter()
+        game.step(DT,inputs)
+        t1=time.perf_counter()
+        steps.append(t1-t0)
+        if render:
+            draw(game,1.0)
+            pygame.display.update()
+            draws.append(time.perf_counter()-t1)
+            clock.tick(FPS)
+    took=time.perf_counter()-began
+    if render: pygame.quit()
+    print(f"{path}: seed {seed}, {len(steps)}/{len(ticks)} ticks in {took:.2f} s ({len(steps)/took:.0f} ticks/s)")
+    print(f"end: hp {game.hp:g}, xp {game.xp}, level {game.level}, {len(game.enemies)} enemies")
+    report("step",steps)
+    if draws: report("draw",draws)
+    if trace:
+        with open(trace,"w") as f:
+            f.write("tick,step_ms,draw_ms\n" if draws else "tick,step_ms\n")
+            for i,t in enumerate(steps):
+                f.write(f"{i},{t*1000:.4f},{draws[i]*1000:.4f}\n" if draws else f"{i},{t*1000:.4f}\n")
 
-    pygame.display.update()
-
-pygame.quit()
+# ================= GAME LOOP =================
+PRESSES = {pygame.K_SPACE: "shoot", pygame.K_e: "talk", pygame.K_h: "heal"}
+
+def main(record=None):
+    open_display()
+    game=Game()
+    load_game(game)
+    recorder=Recorder(record,game) if record else None
+    autosave=Autosaver()
+    gc.freeze()  # world is loaded: keep it out of full collections so they stay short mid-frame
+    paused=False
+    running=True
+    pressed={}  # presses not yet seen by a step
+    lag=0.0  # simulated time owed to the wall clock
+    last=time.perf_counter()
+    while running:
+        clock.tick(FPS)
+        for e in pygame.event.get():
+            if e.type==pygame.QUIT:
+                running=False
+            if e.type==pygame.KEYDOWN:
+                if e.key==pygame.K_p: paused=not paused
+                if e.key in PRESSES: pressed[PRESSES[e.key]]=True
+        if not running:  # the final save is the world as the recording leaves it
+            autosave.close(game); break
+
+        now=time.perf_counter()
+        frame=min(now-last,MAX_FRAME); last=now
+        if paused:
+            pressed.clear()
+            screen.fill(BLACK)
+            draw_text("PAUSED",WIDTH//2-40,HEIGHT//2)
+            pygame.display.update(); continue
+
+        # Fixed steps for the time that passed; each press goes to the first of them
+        lag+=frame
+        dx,dy=get_input()
+        while lag>=DT:
+            inputs=IDLE._replace(dx=dx,dy=dy,**pressed)
+            if recorder: recorder.log(inputs)
+            game.step(DT,inputs)
+            pressed.clear(); lag-=DT
+
+        # Death
+        if game.hp<=0:
+            screen.fill(BLACK)
+            draw_text("YOU DIED",WIDTH//2-40,HEIGHT//2,RED)
+            pygame.display.update()
+            pygame.time.delay(3000)
+            break
+        autosave.tick(game)  # after the death check, so a dead world is never saved
+
+        draw(game,lag/DT)
+        pygame.display.update()
+    if running: autosave.close()
+    if recorder: recorder.close()
+    pygame.quit()
+
+if __name__ == "__main__":
+    ap=argparse.ArgumentParser(description="MEGA SINGLE FILE RPG")
+    ap.add_argument("--bench",action="store_true",help="run the headless benchmarks instead of the game")
+    ap.add_argument("--record",metavar="FILE",help="log the seed and every tick's inputs to FILE")
+    ap.add_argument("--replay",metavar="FILE",help="re-run a recorded session headless, as fast as it goes")
+    ap.add_argument("--render",action="store_true",help="with --replay: draw it in a window at normal speed")
+    ap.add_argument("--trace",metavar="CSV",help="with --replay: write per-tick timings to CSV")
+    args=ap.parse_args()
+    if args.bench:
+        benchmark()
+    elif args.replay:
+        replay(args.replay,args.render,args.trace)
+    else:
+        main(args.record)
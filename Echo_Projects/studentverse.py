@@ -11,33 +11,531 @@
 # ==================================================
 
 import os
+import re
 import sys
+import csv
+import gzip
+import json
 import sqlite3
 import hashlib
 import secrets
 import getpass
+import atexit
+import inspect
 import datetime
+import traceback
+import argparse
+import math
+import heapq
+import calendar
+import random
+import shutil
+import time
+import queue
+import asyncio
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import chain, islice
 from pathlib import Path
-from typing import Optional, Tuple, List
+from typing import Iterable, Iterator, NamedTuple, Optional, Tuple, List
 
 DB_NAME = "studentverse.db"
-CLEAR_CMD = "cls" if os.name == "nt" else "clear"
 
+# Connection tuning (see Storage._connect)
+POOL_SIZE = 4                  # long-lived reader connections
+STATEMENT_CACHE_SIZE = 128     # prepared statements kept per connection
+CACHE_SIZE_KIB = 8 * 1024      # page cache per connection
+MMAP_SIZE = 64 * 1024 * 1024   # memory-mapped I/O window
 
-# ------------------ UTILITIES ------------------
+# Password hashing parameters: "<algorithm>:<cost...>", stored per user in users.pw_params.
+#   pbkdf2_sha256:<iterations>    scrypt:<n>:<r>:<p>
+LEGACY_HASH_PARAMS = "pbkdf2_sha256:200000"   # what every hash was before parameters were stored
+DEFAULT_HASH_PARAMS = LEGACY_HASH_PARAMS      # used until `calibrate` saves something else
+MIN_PBKDF2_ITERATIONS = 100_000
+MIN_SCRYPT_N = 2 ** 14
+
+# Password hashing pool (see HashingService)
+HASH_WORKERS = os.cpu_count() or 1
+HASH_MAX_PENDING = HASH_WORKERS * 4   # jobs in flight before submitters block
+
+# Group commit (see WriteBuffer)
+WRITE_BUFFER_INTERVAL_MS = 50  # flush at least this often...
+WRITE_BUFFER_MAX_ROWS = 500    # ...or as soon as this many rows are waiting
+
+# Bulk import / export: tables in dependency order with the columns that travel
+EXPORT_TABLES = {
+    "users": ("id", "username", "pw_salt", "pw_hash", "pw_params", "created_at"),
+    "notes": ("id", "user_id", "note", "created_at"),
+    "plans": ("id", "user_id", "plan", "created_at", "plan_date", "repeat_rule", "repeat_until"),
+    "quiz_scores": ("id", "user_id", "score", "total", "created_at"),
+    "questions": ("id", "topic", "difficulty", "question", "answer", "alternatives"),
+}
+USER_TABLES = ("notes", "plans", "quiz_scores")  # rows owned by a user (user_id second in EXPORT_TABLES)
+IMPORT_BATCH = 5000            # rows per executemany/transaction when importing
+OPTIONAL_COLUMNS = {"plan_date", "repeat_rule", "repeat_until"}  # NULL when empty or missing (older exports)
+
+# Question bank (see migration 7 and Storage.sample_questions)
+QUESTION_COLUMNS = ("topic", "difficulty", "question", "answer", "alternatives")
+DIFFICULTIES = {1: "easy", 2: "medium", 3: "hard"}
+QUIZ_LENGTH = 3                # default questions per quiz
+SMALL_BANK = 1000              # up to this many matching questions, sample from the full id list
+
+# Sessions (see Storage.create_session)
+SESSION_DAYS = 14              # how long "stay logged in" lasts
+SESSION_CACHE_TTL = 60.0       # seconds a validated token is trusted from memory
+SESSION_CACHE_SIZE = 10000     # validated tokens kept in memory; the least recently used go first
+
+# Progress statistics (see migration 5)
+TREND_ALPHA = 0.3              # weight of the newest attempt in the recent-trend moving average
+TREND_THRESHOLD = 2.0          # percentage points the trend must differ from the average to count
+PROGRESS_WEEKS = 8             # weeks shown in the weekly rollup
+
+# Leaderboard (see Storage.get_leaderboard)
+LEADERBOARD_SIZE = 10
+LEADERBOARD_MIN_ATTEMPTS = 3   # attempts needed to appear on the average board
+LEADERBOARD_TTL = 5.0          # seconds a cached board is reused (local score writes clear it at once)
+LEADERBOARD_ORDER = {
+    # board -> (sort expression, extra filter); the expressions match the migration 6 indexes
+    "best": ("best_pct", ""),
+    "average": ("pct_sum / attempts", f"AND attempts >= {LEADERBOARD_MIN_ATTEMPTS}"),
+}
+
+# History cache (see HistoryCache)
+HISTORY_CACHE_USERS = 256      # (table, user) histories kept in memory; 0 turns the cache off
+HISTORY_CACHE_ROWS = 200       # newest rows kept per history
+HISTORY_CACHE_TTL = 300.0      # seconds before a cached history is re-read regardless
+
+# Network server (see Server)
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8765
+SERVER_THREADS = 16            # executor threads for blocking SQLite calls
+SERVER_LINE_LIMIT = 1 << 20    # longest request line (bytes); longer ones get an error and a hang-up
+
+# Instrumentation (see Profiler); opt in with --profile or STUDENTVERSE_PROFILE=1
+PROFILE_ENV = "STUDENTVERSE_PROFILE"
+SLOW_MS_ENV = "STUDENTVERSE_SLOW_MS"
+SLOW_LOG_ENV = "STUDENTVERSE_SLOW_LOG"
+SLOW_QUERY_MS = 50.0
+SLOW_QUERY_LOG = "studentverse-slow.log"
+
+# History queries
+PAGE_SIZE = 10                 # rows per screen in the UI
+STREAM_BATCH = 500             # rows fetched per round trip when streaming
+FTS_BACKFILL_BATCH = 5000      # notes indexed per transaction when backfilling search
+
+# Note storage tiers (see Storage.compress_notes / Storage.archive_notes)
+NOTE_COMPRESS_MIN = 512        # note bodies of at least this many bytes are stored zlib-compressed
+NOTE_COMPRESS_LEVEL = 6
+ARCHIVE_SUFFIX = ".archive.db" # archive database file, next to the main one
+ARCHIVE_DAYS = 180             # `archive` moves notes older than this out of the hot tier
+ARCHIVE_BATCH = 2000           # notes compressed or moved per transaction
+
+# Sharding (see ShardedStorage); the shard count is kept in the directory database's meta table
+SHARD_SUFFIX = ".shard{index}.db"   # shard files, next to the directory database
+
+# Study planner (see Storage.iter_agenda)
+REPEAT_RULES = ("daily", "weekdays", "weekly", "biweekly", "monthly")
+REPEAT_STEP_DAYS = {"daily": 1, "weekdays": 1, "weekly": 7, "biweekly": 14}
+AGENDA_PERIODS = ("today", "this week", "next 7 days", "next 30 days", "this month")
+AGENDA_LIMIT = 100             # agenda entries the server returns per request
+
+# Keyset pagination cursor: (created_at, id) of the last row on the previous page
+Cursor = Tuple[str, int]
+
+# Percentage of a quiz_scores row, as used by the statistics triggers
+PCT_SQL = "(CASE WHEN {row}total > 0 THEN {row}score * 100.0 / {row}total ELSE 0.0 END)"
+NEW_PCT, ROW_PCT = PCT_SQL.format(row="new."), PCT_SQL.format(row="")
+
+# ISO 8601 week of a quiz_scores row, as date.isocalendar() gives it ("2025-W01"): the year and
+# week number of its Thursday, so the days around New Year share one week
+WEEK_SQL = ("(strftime('%Y', date({row}created_at, '-3 days', 'weekday 4')) || '-W' || "
+            "printf('%02d', (strftime('%j', date({row}created_at, '-3 days', 'weekday 4')) - 1) / 7 + 1))")
+NEW_WEEK, ROW_WEEK = WEEK_SQL.format(row="new."), WEEK_SQL.format(row="")
+OLD_WEEK_SQL = "strftime('%Y-W%W', new.created_at)"  # until migration 11; splits the week of New Year
+
+# Keeps quiz_stats and quiz_weekly current; {week} is the week key of the new row
+QUIZ_STATS_TRIGGER = f"""
+CREATE TRIGGER IF NOT EXISTS quiz_stats_ai AFTER INSERT ON quiz_scores BEGIN
+    INSERT INTO quiz_stats (user_id, attempts, pct_sum, best_pct, best_score, best_total,
+                            last_pct, ema_pct, last_at)
+    VALUES (new.user_id, 1, {NEW_PCT}, {NEW_PCT}, new.score, new.total,
+            {NEW_PCT}, {NEW_PCT}, new.created_at)
+    ON CONFLICT (user_id) DO UPDATE SET
+        attempts = attempts + 1,
+        pct_sum = pct_sum + excluded.pct_sum,
+        best_score = CASE WHEN excluded.best_pct > best_pct THEN excluded.best_score ELSE best_score END,
+        best_total = CASE WHEN excluded.best_pct > best_pct THEN excluded.best_total ELSE best_total END,
+        best_pct = MAX(best_pct, excluded.best_pct),
+        last_pct = excluded.last_pct,
+        ema_pct = ema_pct + {TREND_ALPHA} * (excluded.last_pct - ema_pct),
+        last_at = excluded.last_at;
+    INSERT INTO quiz_weekly (user_id, week, attempts, pct_sum, best_pct)
+    VALUES (new.user_id, {{week}}, 1, {NEW_PCT}, {NEW_PCT})
+    ON CONFLICT (user_id, week) DO UPDATE SET
+        attempts = attempts + 1,
+        pct_sum = pct_sum + excluded.pct_sum,
+        best_pct = MAX(best_pct, excluded.best_pct);
+END;
+"""
+
+# Text of a notes row: compressed bodies live in note_z (note is then ''), see pack_note
+NOTE_TEXT_SQL = "(CASE WHEN {row}note_z IS NULL THEN {row}note ELSE unzip_note({row}note_z) END)"
+NEW_TEXT, OLD_TEXT, ROW_TEXT = (NOTE_TEXT_SQL.format(row=row) for row in ("new.", "old.", ""))
+
+# Schema migrations, applied in order on top of the base tables and tracked in PRAGMA user_version.
+MIGRATIONS = [
+    # 1: composite indexes so per-user history is an index range scan, not a table scan
+    """
+    CREATE INDEX IF NOT EXISTS idx_notes_user_created ON notes(user_id, created_at, id);
+    CREATE INDEX IF NOT EXISTS idx_plans_user_created ON plans(user_id, created_at, id);
+    CREATE INDEX IF NOT EXISTS idx_quiz_scores_user_created ON quiz_scores(user_id, created_at, id);
+    """,
+    # 2: full-text search over notes. External-content FTS5 table kept in sync by triggers.
+    # user_id is indexed too so a search is an index intersection inside one user's notes.
+    # Notes that existed before this migration (id <= notes_fts_backfill_upto) are indexed
+    # later in batches by Storage._backfill_notes_fts; until then the triggers leave them alone.
+    """
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value
+    );
+    CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+        note, user_id, content='notes', content_rowid='id'
+    );
+    INSERT OR REPLACE INTO meta (key, value)
+        SELECT 'notes_fts_backfill_upto', COALESCE(MAX(id), 0) FROM notes;
+    CREATE TRIGGER IF NOT EXISTS notes_fts_ai AFTER INSERT ON notes BEGIN
+        INSERT INTO notes_fts (rowid, note, user_id) VALUES (new.id, new.note, new.user_id);
+    END;
+    CREATE TRIGGER IF NOT EXISTS notes_fts_ad AFTER DELETE ON notes
+    WHEN old.id > COALESCE((SELECT value FROM meta WHERE key = 'notes_fts_backfill_upto'), 0) BEGIN
+        INSERT INTO notes_fts (notes_fts, rowid, note, user_id) VALUES ('delete', old.id, old.note, old.user_id);
+    END;
+    CREATE TRIGGER IF NOT EXISTS notes_fts_au AFTER UPDATE ON notes
+    WHEN old.id > COALESCE((SELECT value FROM meta WHERE key = 'notes_fts_backfill_upto'), 0) BEGIN
+        INSERT INTO notes_fts (notes_fts, rowid, note, user_id) VALUES ('delete', old.id, old.note, old.user_id);
+        INSERT INTO notes_fts (rowid, note, user_id) VALUES (new.id, new.note, new.user_id);
+    END;
+    """,
+    # 3: per-user password hash algorithm/cost; existing hashes are the old fixed PBKDF2
+    f"""
+    ALTER TABLE users ADD COLUMN pw_params TEXT NOT NULL DEFAULT '{LEGACY_HASH_PARAMS}';
+    """,
+    # 4: login sessions. Only a SHA-256 of each token is stored; expires_at is indexed for pruning.
+    """
+    CREATE TABLE IF NOT EXISTS sessions (
+        token_hash TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        created_at TEXT NOT NULL,
+        expires_at TEXT NOT NULL,
+        revoked INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at);
+    CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id);
+    """,
+    # 5: per-user quiz statistics and a weekly rollup, maintained by a trigger on every new
+    # score so the Progress Tracker never rescans quiz_scores (scores are append-only).
+    # ema_pct is an exponential moving average of recent percentages (the "trend").
+    f"""
+    CREATE TABLE IF NOT EXISTS quiz_stats (
+        user_id INTEGER PRIMARY KEY,
+        attempts INTEGER NOT NULL,
+        pct_sum REAL NOT NULL,
+        best_pct REAL NOT NULL,
+        best_score INTEGER NOT NULL,
+        best_total INTEGER NOT NULL,
+        last_pct REAL NOT NULL,
+        ema_pct REAL NOT NULL,
+        last_at TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS quiz_weekly (
+        user_id INTEGER NOT NULL,
+        week TEXT NOT NULL,
+        attempts INTEGER NOT NULL,
+        pct_sum REAL NOT NULL,
+        best_pct REAL NOT NULL,
+        PRIMARY KEY (user_id, week)
+    ) WITHOUT ROWID;
+    {QUIZ_STATS_TRIGGER.format(week=OLD_WEEK_SQL)}
+    INSERT OR IGNORE INTO quiz_stats
+        SELECT best.user_id, totals.attempts, totals.pct_sum, best.pct, best.score, best.total,
+               latest.pct, totals.pct_sum / totals.attempts, latest.created_at
+        FROM (SELECT user_id, score, total, created_at, {ROW_PCT} AS pct,
+                     ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY {ROW_PCT} DESC) AS best_rank
+              FROM quiz_scores) AS best
+        JOIN (SELECT user_id, COUNT(*) AS attempts, SUM({ROW_PCT}) AS pct_sum
+              FROM quiz_scores GROUP BY user_id) AS totals ON totals.user_id = best.user_id
+        JOIN (SELECT user_id, created_at, {ROW_PCT} AS pct,
+                     ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY created_at DESC, id DESC) AS recent_rank
+              FROM quiz_scores) AS latest ON latest.user_id = best.user_id AND latest.recent_rank = 1
+        WHERE best.best_rank = 1;
+    INSERT OR IGNORE INTO quiz_weekly
+        SELECT user_id, strftime('%Y-W%W', created_at), COUNT(*), SUM({ROW_PCT}), MAX({ROW_PCT})
+        FROM quiz_scores GROUP BY user_id, strftime('%Y-W%W', created_at);
+    """,
+    # 6: leaderboard indexes over the per-user summaries, so top-K is an index scan
+    # and a user's rank is an index range count; quiz_scores itself is never aggregated.
+    """
+    CREATE INDEX IF NOT EXISTS idx_quiz_stats_best ON quiz_stats(best_pct DESC, user_id);
+    CREATE INDEX IF NOT EXISTS idx_quiz_stats_average ON quiz_stats(pct_sum / attempts DESC, user_id, attempts);
+    """,
+    # 7: question bank, indexed for random sampling by topic and/or difficulty.
+    # alternatives: other accepted answers separated by "|"; "re:<pattern>" entries are regexes.
+    """
+    CREATE TABLE IF NOT EXISTS questions (
+        id INTEGER PRIMARY KEY,
+        topic TEXT NOT NULL,
+        difficulty INTEGER NOT NULL DEFAULT 1,
+        question TEXT NOT NULL,
+        answer TEXT NOT NULL,
+        alternatives TEXT NOT NULL DEFAULT ''
+    );
+    CREATE INDEX IF NOT EXISTS idx_questions_topic_difficulty ON questions(topic, difficulty, id);
+    CREATE INDEX IF NOT EXISTS idx_questions_topic ON questions(topic, id);
+    CREATE INDEX IF NOT EXISTS idx_questions_difficulty ON questions(difficulty, id);
+    INSERT INTO questions (topic, difficulty, question, answer, alternatives) VALUES
+        ('math', 1, 'What is 2 + 2?', '4', 'four'),
+        ('geography', 1, 'Capital of India?', 'delhi', 'new delhi'),
+        ('python', 1, 'Which language is this project in?', 'python', 'python3|python 3');
+    """,
+    # 8: compressed note bodies. Search now indexes the notes_text view (decompressed text)
+    # instead of notes itself, so the FTS table is recreated and refilled by the backfill.
+    f"""
+    ALTER TABLE notes ADD COLUMN note_z BLOB;
+    CREATE VIEW IF NOT EXISTS notes_text AS SELECT id, {ROW_TEXT} AS note, user_id FROM notes;
+    DROP TRIGGER IF EXISTS notes_fts_ai;
+    DROP TRIGGER IF EXISTS notes_fts_ad;
+    DROP TRIGGER IF EXISTS notes_fts_au;
+    DROP TABLE IF EXISTS notes_fts;
+    CREATE VIRTUAL TABLE notes_fts USING fts5(
+        note, user_id, content='notes_text', content_rowid='id'
+    );
+    INSERT OR REPLACE INTO meta (key, value)
+        SELECT 'notes_fts_backfill_upto', COALESCE(MAX(id), 0) FROM notes;
+    CREATE TRIGGER notes_fts_ai AFTER INSERT ON notes BEGIN
+        INSERT INTO notes_fts (rowid, note, user_id) VALUES (new.id, {NEW_TEXT}, new.user_id);
+    END;
+    CREATE TRIGGER notes_fts_ad AFTER DELETE ON notes
+    WHEN old.id > COALESCE((SELECT value FROM meta WHERE key = 'notes_fts_backfill_upto'), 0) BEGIN
+        INSERT INTO notes_fts (notes_fts, rowid, note, user_id) VALUES ('delete', old.id, {OLD_TEXT}, old.user_id);
+    END;
+    CREATE TRIGGER notes_fts_au AFTER UPDATE ON notes
+    WHEN old.id > COALESCE((SELECT value FROM meta WHERE key = 'notes_fts_backfill_upto'), 0) BEGIN
+        INSERT INTO notes_fts (notes_fts, rowid, note, user_id) VALUES ('delete', old.id, {OLD_TEXT}, old.user_id);
+        INSERT INTO notes_fts (rowid, note, user_id) VALUES (new.id, {NEW_TEXT}, new.user_id);
+    END;
+    """,
+    # 9: dated plans with optional recurrence (repeat_rule from REPEAT_RULES, repeat_until
+    # inclusive). Only the rule is stored; Storage.iter_agenda expands it for the dates asked for.
+    # The partial index keeps the recurring plans of a user to a short range scan.
+    """
+    ALTER TABLE plans ADD COLUMN plan_date TEXT;
+    ALTER TABLE plans ADD COLUMN repeat_rule TEXT;
+    ALTER TABLE plans ADD COLUMN repeat_until TEXT;
+    CREATE INDEX IF NOT EXISTS idx_plans_user_date ON plans(user_id, plan_date);
+    CREATE INDEX IF NOT EXISTS idx_plans_user_repeating ON plans(user_id, plan_date) WHERE repeat_rule IS NOT NULL;
+    """,
+    # 10: the search triggers of 8 call unzip_note(), which only Storage connections define, so
+    # nothing else could write notes. These index plain-text rows only; compressed rows are
+    # indexed by the temporary ZIPPED_NOTES_FTS triggers every Storage connection creates.
+    # Updates unindex in BEFORE triggers and index in AFTER ones: the two sets fire in no set
+    # order, and FTS5 must see a row's delete before its new insert.
+    """
+    DROP TRIGGER IF EXISTS notes_fts_ai;
+    DROP TRIGGER IF EXISTS notes_fts_ad;
+    DROP TRIGGER IF EXISTS notes_fts_au;
+    CREATE TRIGGER notes_fts_plain_ai AFTER INSERT ON notes WHEN new.note_z IS NULL BEGIN
+        INSERT INTO notes_fts (rowid, note, user_id) VALUES (new.id, new.note, new.user_id);
+    END;
+    CREATE TRIGGER notes_fts_plain_ad AFTER DELETE ON notes WHEN old.note_z IS NULL
+    AND old.id > COALESCE((SELECT value FROM meta WHERE key = 'notes_fts_backfill_upto'), 0) BEGIN
+        INSERT INTO notes_fts (notes_fts, rowid, note, user_id) VALUES ('delete', old.id, old.note, old.user_id);
+    END;
+    CREATE TRIGGER notes_fts_plain_bu BEFORE UPDATE ON notes WHEN old.note_z IS NULL
+    AND old.id > COALESCE((SELECT value FROM meta WHERE key = 'notes_fts_backfill_upto'), 0) BEGIN
+        INSERT INTO notes_fts (notes_fts, rowid, note, user_id) VALUES ('delete', old.id, old.note, old.user_id);
+    END;
+    CREATE TRIGGER notes_fts_plain_au AFTER UPDATE ON notes WHEN new.note_z IS NULL
+    AND old.id > COALESCE((SELECT value FROM meta WHERE key = 'notes_fts_backfill_upto'), 0) BEGIN
+        INSERT INTO notes_fts (rowid, note, user_id) VALUES (new.id, new.note, new.user_id);
+    END;
+    """,
+    # 11: ISO weeks in the weekly rollup. '%Y-W%W' cut the week spanning New Year in two
+    # (the second half as W00); the rollup is rebuilt from quiz_scores with the new keys.
+    f"""
+    DROP TRIGGER IF EXISTS quiz_stats_ai;
+    {QUIZ_STATS_TRIGGER.format(week=NEW_WEEK)}
+    DELETE FROM quiz_weekly;
+    INSERT INTO quiz_weekly
+        SELECT user_id, {ROW_WEEK}, COUNT(*), SUM({ROW_PCT}), MAX({ROW_PCT})
+        FROM quiz_scores GROUP BY user_id, {ROW_WEEK};
+    """,
+]
+
+# Cold tier: notes moved out by Storage.archive_notes, attached to every connection as "archive".
+# Rows keep their ids (notes uses AUTOINCREMENT, so ids are never reused) and have their own
+# search index, so history and search read both tiers.
+ARCHIVE_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS archive.notes (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    note TEXT NOT NULL,
+    note_z BLOB,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS archive.idx_notes_user_created ON notes(user_id, created_at, id);
+CREATE VIEW IF NOT EXISTS archive.notes_text AS SELECT id, {ROW_TEXT} AS note, user_id FROM notes;
+CREATE VIRTUAL TABLE IF NOT EXISTS archive.notes_fts USING fts5(
+    note, user_id, content='notes_text', content_rowid='id'
+);
+DROP TRIGGER IF EXISTS archive.notes_fts_ai;
+DROP TRIGGER IF EXISTS archive.notes_fts_ad;
+CREATE TRIGGER IF NOT EXISTS archive.notes_fts_plain_ai AFTER INSERT ON notes WHEN new.note_z IS NULL BEGIN
+    INSERT INTO notes_fts (rowid, note, user_id) VALUES (new.id, new.note, new.user_id);
+END;
+CREATE TRIGGER IF NOT EXISTS archive.notes_fts_plain_ad AFTER DELETE ON notes WHEN old.note_z IS NULL BEGIN
+    INSERT INTO notes_fts (notes_fts, rowid, note, user_id) VALUES ('delete', old.id, old.note, old.user_id);
+END;
+"""
+
+# Search index of compressed hot notes. Only connections that define unzip_note() can decompress
+# a body, so these are TEMP triggers on the writer connection (see Storage._ensure_db) and the
+# schema's own triggers, which any connection runs, index plain-text rows only. Compressed
+# archive rows are indexed by Storage.archive_notes and unindexed by _delete_user_rows.
+ZIPPED_NOTES_FTS = f"""
+CREATE TEMP TRIGGER IF NOT EXISTS notes_fts_zipped_ai AFTER INSERT ON main.notes
+WHEN new.note_z IS NOT NULL BEGIN
+    INSERT INTO notes_fts (rowid, note, user_id) VALUES (new.id, {NEW_TEXT}, new.user_id);
+END;
+CREATE TEMP TRIGGER IF NOT EXISTS notes_fts_zipped_ad AFTER DELETE ON main.notes WHEN old.note_z IS NOT NULL
+AND old.id > COALESCE((SELECT value FROM meta WHERE key = 'notes_fts_backfill_upto'), 0) BEGIN
+    INSERT INTO notes_fts (notes_fts, rowid, note, user_id) VALUES ('delete', old.id, {OLD_TEXT}, old.user_id);
+END;
+CREATE TEMP TRIGGER IF NOT EXISTS notes_fts_zipped_bu BEFORE UPDATE ON main.notes WHEN old.note_z IS NOT NULL
+AND old.id > COALESCE((SELECT value FROM meta WHERE key = 'notes_fts_backfill_upto'), 0) BEGIN
+    INSERT INTO notes_fts (notes_fts, rowid, note, user_id) VALUES ('delete', old.id, {OLD_TEXT}, old.user_id);
+END;
+CREATE TEMP TRIGGER IF NOT EXISTS notes_fts_zipped_au AFTER UPDATE ON main.notes WHEN new.note_z IS NOT NULL
+AND old.id > COALESCE((SELECT value FROM meta WHERE key = 'notes_fts_backfill_upto'), 0) BEGIN
+    INSERT INTO notes_fts (rowid, note, user_id) VALUES (new.id, {NEW_TEXT}, new.user_id);
+END;
+"""
+
+# Both tiers as one per-connection view; history reads of notes go through it
+NOTES_ALL_VIEW = f"""
+CREATE TEMP VIEW IF NOT EXISTS notes_all AS
+    SELECT id, user_id, created_at, {ROW_TEXT} AS note FROM main.notes
+    UNION ALL
+    SELECT id, user_id, created_at, {ROW_TEXT} AS note FROM archive.notes
+"""
+
+
+# ------------------ SCREEN (console rendering) ------------------
+
+class Screen:
+    """
+    Draws console screens with ANSI escape sequences instead of running `clear`.
+    A screen is composed as a list of lines and written in one go: the first frame clears
+    the terminal; later frames move the cursor home, rewrite only the lines that differ
+    from the previous frame and erase whatever was printed below it.
+    While installed as sys.stdout it counts the rows written under the frame (prints,
+    prompts, echoed answers); if the terminal may have scrolled, the next frame is a
+    full redraw. Output that is not a terminal (pipe, file, TERM=dumb) gets plain lines.
+    """
+    def __init__(self, out=None):
+        self.out = out or sys.stdout
+        self._frame: List[str] = []
+        self._rows_below = 0
+        self._installed = False
+
+    @property
+    def ansi(self) -> bool:
+        isatty = getattr(self.out, "isatty", None)
+        return bool(isatty and isatty()) and os.environ.get("TERM") != "dumb"
+
+    @contextmanager
+    def installed(self):
+        """Route print() through the screen so it can tell what is under the frame."""
+        self.out = sys.stdout
+        if os.name == "nt" and self.ansi:
+            try:  # let the Windows console interpret escape sequences
+                import ctypes
+                kernel32 = ctypes.windll.kernel32
+                kernel32.SetConsoleMode(kernel32.GetStdHandle(-11), 7)
+            except Exception:
+                pass
+        sys.stdout, self._installed = self, True
+        try:
+            yield self
+        finally:
+            sys.stdout, self._installed = self.out, False
+
+    # file-like surface, so the screen can stand in for sys.stdout
+    def write(self, text: str) -> int:
+        self.out.write(text)
+        if "\n" in text:
+            width = max(shutil.get_terminal_size().columns, 1)
+            self._rows_below += sum(1 + len(line) // width for line in text.split("\n")[:-1])
+        return len(text)
 
-def clear():
-    os.system(CLEAR_CMD)
+    def flush(self):
+        self.out.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.out, name)
+
+    def input(self, prompt: str = "") -> str:
+        answer = input(prompt)
+        self._rows_below += 1 + len(prompt + answer) // max(shutil.get_terminal_size().columns, 1)
+        return answer
+
+    def getpass(self, prompt: str = "Password: ") -> str:
+        answer = getpass.getpass(prompt)
+        self._rows_below += 1
+        return answer
+
+    def draw(self, lines: List[str]):
+        if not self.ansi:
+            self.out.write("\n" + "\n".join(lines) + "\n")
+            self._frame, self._rows_below = list(lines), 0
+            return
+        width, height = shutil.get_terminal_size()
+        full = (not self._installed or not self._frame
+                or len(self._frame) + self._rows_below >= height - 1
+                or any(len(line) >= width for line in lines))
+        if full:
+            buf = ["\033[H\033[2J"] + [line + "\n" for line in lines]
+        else:
+            buf = [f"\033[{row};1H{line}\033[K"
+                   for row, line in enumerate(lines, start=1)
+                   if row > len(self._frame) or self._frame[row - 1] != line]
+            buf.append(f"\033[{len(lines) + 1};1H\033[J")
+        self.out.write("".join(buf))
+        self.out.flush()
+        self._frame, self._rows_below = list(lines), 0
+
+
+screen = Screen()
+
+
+# ------------------ UTILITIES ------------------
 
 def pause(prompt: str = "\nPress Enter to continue..."):
-    input(prompt)
+    screen.input(prompt)
 
 def now_iso() -> str:
     return datetime.datetime.utcnow().isoformat(sep=" ", timespec="seconds")
 
+def iso_in(**delta) -> str:
+    return (datetime.datetime.utcnow() + datetime.timedelta(**delta)).isoformat(sep=" ", timespec="seconds")
+
 def safe_int(prompt: str, min_value: int = None, max_value: int = None) -> int:
     while True:
-        s = input(prompt).strip()
+        s = screen.input(prompt).strip()
         try:
             val = int(s)
         except ValueError:
@@ -53,7 +551,7 @@ def safe_int(prompt: str, min_value: int = None, max_value: int = None) -> int:
 
 def prompt_nonempty(prompt: str) -> str:
     while True:
-        s = input(prompt).strip()
+        s = screen.input(prompt).strip()
         if s:
             return s
         print("Input cannot be empty.")
@@ -61,43 +559,757 @@ def prompt_nonempty(prompt: str) -> str:
 def prompt_choice(prompt: str, choices: List[str]) -> str:
     choices_set = set(choices)
     while True:
-        s = input(prompt).strip()
+        s = screen.input(prompt).strip()
         if s in choices_set:
             return s
         print(f"Invalid choice. Choose one of: {', '.join(choices)}")
 
+def prompt_date(prompt: str) -> Optional[datetime.date]:
+    """YYYY-MM-DD, "today" or "tomorrow"; blank for no date."""
+    while True:
+        s = screen.input(prompt).strip().lower()
+        if not s:
+            return None
+        if s in ("today", "tomorrow"):
+            return datetime.date.today() + datetime.timedelta(days=s == "tomorrow")
+        try:
+            return datetime.date.fromisoformat(s)
+        except ValueError:
+            print("Please enter a date as YYYY-MM-DD (or today / tomorrow).")
+
 
 # ------------------ SECURITY (password hashing) ------------------
 
-def hash_password(password: str, salt: Optional[bytes] = None) -> Tuple[str, str]:
+def derive_key(password: str, salt: bytes, params: str) -> bytes:
+    algorithm, *cost = params.split(":")
+    if algorithm == "pbkdf2_sha256":
+        return hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, int(cost[0]))
+    if algorithm == "scrypt":
+        n, r, p = (int(c) for c in cost)
+        return hashlib.scrypt(password.encode("utf-8"), salt=salt, n=n, r=r, p=p,
+                              maxmem=128 * r * (n + p + 2) + 1024 * 1024, dklen=32)
+    raise ValueError(f"Unknown password hash algorithm: {algorithm!r}")
+
+def hash_password(password: str, salt: Optional[bytes] = None,
+                  params: str = DEFAULT_HASH_PARAMS) -> Tuple[str, str]:
     """
     Returns (salt_hex, hash_hex). If salt given, reuse it; else generate new 16-byte salt.
-    Uses PBKDF2-HMAC-SHA256 with 200_000 iterations.
+    `params` selects the algorithm and cost, e.g. "pbkdf2_sha256:200000" or "scrypt:16384:8:1".
     """
     if salt is None:
         salt = secrets.token_bytes(16)
-    hash_bytes = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, 200_000)
-    return salt.hex(), hash_bytes.hex()
+    return salt.hex(), derive_key(password, salt, params).hex()
 
-def verify_password(stored_salt_hex: str, stored_hash_hex: str, provided_password: str) -> bool:
+def verify_password(stored_salt_hex: str, stored_hash_hex: str, provided_password: str,
+                    params: str = LEGACY_HASH_PARAMS) -> bool:
     salt = bytes.fromhex(stored_salt_hex)
-    _, hash_hex = hash_password(provided_password, salt)
+    _, hash_hex = hash_password(provided_password, salt, params)
     return secrets.compare_digest(hash_hex, stored_hash_hex)
 
+def token_digest(token: str) -> str:
+    # session tokens are 256 random bits, so one fast hash is enough (no salt/stretching needed)
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+def calibrate_hash_params(target_ms: float, algorithm: str = "pbkdf2_sha256") -> str:
+    """Pick the costliest parameters whose verify time on this machine stays near `target_ms`."""
+    def cost_ms(params: str) -> float:
+        start = time.perf_counter()
+        derive_key("calibration", b"\0" * 16, params)
+        return (time.perf_counter() - start) * 1000
+
+    if algorithm == "pbkdf2_sha256":
+        probe = 50_000
+        per_iteration = min(cost_ms(f"pbkdf2_sha256:{probe}") for _ in range(3)) / probe
+        iterations = int(target_ms / per_iteration) // 10_000 * 10_000
+        return f"pbkdf2_sha256:{max(iterations, MIN_PBKDF2_ITERATIONS)}"
+    if algorithm == "scrypt":
+        n = MIN_SCRYPT_N
+        while cost_ms(f"scrypt:{n * 2}:8:1") <= target_ms:
+            n *= 2
+        return f"scrypt:{n}:8:1"
+    raise ValueError(f"Unknown password hash algorithm: {algorithm!r}")
+
+
+class HashingService:
+    """
+    Runs PBKDF2 in a pool of worker processes (one per core by default) so many
+    registrations/logins hash in parallel instead of queueing on the calling thread.
+    At most `max_pending` jobs are in flight; further submitters block until a slot
+    frees up (backpressure), so a burst of logins cannot pile up unbounded work.
+    """
+    def __init__(self, workers: int = HASH_WORKERS, max_pending: Optional[int] = None):
+        self.workers = workers
+        self._pool = ProcessPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(max_pending or workers * 4)
+
+    def submit(self, fn, *args) -> Future:
+        self._slots.acquire()
+        try:
+            future = self._pool.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def hash_password(self, password: str, salt: Optional[bytes] = None,
+                      params: str = DEFAULT_HASH_PARAMS) -> Future:
+        return self.submit(hash_password, password, salt, params)
+
+    def verify_password(self, stored_salt_hex: str, stored_hash_hex: str, provided_password: str,
+                        params: str = LEGACY_HASH_PARAMS) -> Future:
+        return self.submit(verify_password, stored_salt_hex, stored_hash_hex, provided_password, params)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
+
+
+# ------------------ INSTRUMENTATION ------------------
+
+class LatencyHistogram:
+    """Log-scale latency buckets (4 per doubling, from 1 µs): bounded memory, ~19% resolution."""
+    STEPS = 4
+
+    def __init__(self):
+        self.buckets: dict = {}
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds: float):
+        us = max(seconds * 1e6, 1.0)
+        bucket = int(math.log2(us) * self.STEPS)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, pct: float) -> float:
+        """Upper edge of the bucket holding the pct-th percentile, in seconds."""
+        rank = self.count * pct / 100
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return 2 ** ((bucket + 1) / self.STEPS) / 1e6
+        return 0.0
+
+
+class Profiler:
+    """
+    Opt-in instrumentation for Storage: latency histograms per public method,
+    per-statement counts and times (from sqlite3's trace callback), connection opens,
+    and a slow-query log. A statement's time runs from its trace callback to the next
+    statement on that connection or to the connection going back to the pool, so it
+    includes fetching the rows and any trigger work.
+    """
+    def __init__(self, slow_ms: float = SLOW_QUERY_MS, slow_log: Optional[str] = SLOW_QUERY_LOG):
+        self.slow = slow_ms / 1000
+        self.slow_log = slow_log
+        self.connections_opened = 0
+        self.methods: dict = {}     # name -> LatencyHistogram
+        self.statements: dict = {}  # normalized sql -> [count, total_seconds, max_seconds]
+        self._running: dict = {}    # id(connection) -> (sql, start)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> Optional["Profiler"]:
+        if os.environ.get(PROFILE_ENV, "") in ("", "0"):
+            return None
+        return cls(float(os.environ.get(SLOW_MS_ENV, SLOW_QUERY_MS)), os.environ.get(SLOW_LOG_ENV, SLOW_QUERY_LOG))
+
+    @staticmethod
+    def normalize(sql: str) -> str:
+        sql = re.sub(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b", "?", sql)
+        return " ".join(sql.split())
+
+    # Methods
+    def instrument(self, obj, names: Iterable[str]):
+        """Replace obj.<name> for each name with a timed wrapper (generators are timed to exhaustion)."""
+        for name in names:
+            method = getattr(obj, name)
+            wrap = self._wrap_generator if inspect.isgeneratorfunction(method) else self._wrap
+            setattr(obj, name, wrap(name, method))
+
+    def record_call(self, name: str, seconds: float):
+        with self._lock:
+            self.methods.setdefault(name, LatencyHistogram()).add(seconds)
+
+    def _wrap(self, name: str, method):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.record_call(name, time.perf_counter() - start)
+        return timed
+
+    def _wrap_generator(self, name: str, method):
+        def timed(*args, **kwargs):
+            elapsed = 0.0
+            it = method(*args, **kwargs)
+            try:
+                while True:
+                    start = time.perf_counter()
+                    try:
+                        item = next(it)
+                    finally:
+                        elapsed += time.perf_counter() - start
+                    yield item
+            except StopIteration:
+                pass
+            finally:
+                self.record_call(name, elapsed)
+        return timed
+
+    # Statements
+    def connection_opened(self, conn: sqlite3.Connection):
+        with self._lock:
+            self.connections_opened += 1
+        conn.set_trace_callback(lambda sql: self._statement_started(conn, sql))
+
+    def _statement_started(self, conn: sqlite3.Connection, sql: str):
+        # Nested statements (trigger bodies are traced as "-- ...", FTS5 shadow-table access
+        # as "'main'.<table>") and re-traces of the running statement belong to that statement.
+        if sql.startswith("--") or "'main'." in sql:
+            return
+        running = self._running.get(id(conn))
+        if running is not None and running[0] == sql:
+            return
+        now = time.perf_counter()
+        self.statement_done(conn, now)
+        self._running[id(conn)] = (sql, now)
+
+    def statement_done(self, conn: sqlite3.Connection, now: Optional[float] = None):
+        running = self._running.pop(id(conn), None)
+        if running is None:
+            return
+        sql, start = running
+        seconds = (now or time.perf_counter()) - start
+        key = self.normalize(sql)
+        with self._lock:
+            stats = self.statements.setdefault(key, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            if seconds >= self.slow and self.slow_log:
+                with open(self.slow_log, "a", encoding="utf-8") as f:
+                    f.write(f"{now_iso()}\t{seconds * 1000:.1f} ms\t{' '.join(sql.split())}\n")
+
+    # Report
+    def report(self, out=None):
+        out = out or sys.stderr
+        print("\n===== STORAGE PROFILE =====", file=out)
+        print(f"connections opened: {self.connections_opened}", file=out)
+        print(f"\n{'method':<28} {'calls':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'total ms':>10}", file=out)
+        for name, h in sorted(self.methods.items(), key=lambda kv: -kv[1].total):
+            print(f"{name:<28} {h.count:>8} {h.percentile(50) * 1000:>9.2f} {h.percentile(95) * 1000:>9.2f} "
+                  f"{h.percentile(99) * 1000:>9.2f} {h.total * 1000:>10.1f}", file=out)
+        print(f"\n{'count':>8} {'total ms':>10} {'max ms':>9}  statement", file=out)
+        for sql, (count, total, worst) in sorted(self.statements.items(), key=lambda kv: -kv[1][1])[:25]:
+            print(f"{count:>8} {total * 1000:>10.1f} {worst * 1000:>9.2f}  {sql[:100]}", file=out)
+        if self.slow_log:
+            print(f"\nstatements over {self.slow * 1000:.0f} ms are logged to {self.slow_log}", file=out)
+
 
 # ------------------ DATABASE LAYER ------------------
 
+def fts_query(text: str) -> str:
+    """Turn free text into a safe FTS5 query: every word quoted, trailing * kept as a prefix match."""
+    terms = []
+    for word in text.split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*")
+        if word:
+            terms.append('"' + word.replace('"', '""') + '"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+
+def pack_note(note: str) -> Tuple[str, Optional[bytes]]:
+    """(note, note_z) column values: bodies of NOTE_COMPRESS_MIN bytes or more go to note_z, zlib-compressed."""
+    data = note.encode("utf-8")
+    if len(data) >= NOTE_COMPRESS_MIN:
+        packed = zlib.compress(data, NOTE_COMPRESS_LEVEL)
+        if len(packed) < len(data):
+            return "", packed
+    return note, None
+
+
+def unzip_note(note_z: Optional[bytes]) -> Optional[str]:
+    """SQL function unzip_note(), used by NOTE_TEXT_SQL."""
+    return None if note_z is None else zlib.decompress(note_z).decode("utf-8")
+
+
+def occurrences(first: datetime.date, rule: Optional[str], until: Optional[datetime.date],
+                start: datetime.date, end: datetime.date) -> Iterator[datetime.date]:
+    """
+    Dates in [start, end] a plan dated `first` falls on under `rule` (None: just `first`),
+    generated lazily. Starts at the first candidate on or after `start` instead of walking
+    from `first`, so an old recurring plan is as cheap as a new one.
+    """
+    if until is not None:
+        end = min(end, until)
+    if rule is None:
+        if start <= first <= end:
+            yield first
+        return
+    if rule == "monthly":  # same day of the month, or the month's last day if it is shorter
+        month = max(0, (start.year - first.year) * 12 + start.month - first.month)
+        while True:
+            year, month0 = divmod(first.month - 1 + month, 12)
+            year += first.year
+            day = datetime.date(year, month0 + 1, min(first.day, calendar.monthrange(year, month0 + 1)[1]))
+            if day > end:
+                return
+            if day >= start:
+                yield day
+            month += 1
+    step = REPEAT_STEP_DAYS[rule]
+    day = first + datetime.timedelta(days=max(0, -(-(start - first).days // step)) * step)
+    while day <= end:
+        if rule != "weekdays" or day.weekday() < 5:
+            yield day
+        day += datetime.timedelta(days=step)
+
+
+def agenda_window(period: str, today: Optional[datetime.date] = None) -> Tuple[datetime.date, datetime.date]:
+    """First and last day (inclusive) of "today", "this week", "this month" or "next N days"."""
+    today = today or datetime.date.today()
+    if period == "today":
+        return today, today
+    if period == "this week":
+        monday = today - datetime.timedelta(days=today.weekday())
+        return monday, monday + datetime.timedelta(days=6)
+    if period == "this month":
+        return today.replace(day=1), today.replace(day=calendar.monthrange(today.year, today.month)[1])
+    match = re.fullmatch(r"next (\d+) days?", period)
+    if match and int(match.group(1)) > 0:
+        return today, today + datetime.timedelta(days=int(match.group(1)) - 1)
+    raise ValueError(f"unknown period {period!r}; try {', '.join(AGENDA_PERIODS)}")
+
+
+class ProgressStats(NamedTuple):
+    attempts: int
+    avg_pct: float
+    best_score: int
+    best_total: int
+    best_pct: float
+    last_pct: float
+    trend_pct: float  # moving average of recent attempts
+    last_at: str
+
+    @property
+    def trend(self) -> str:
+        if self.trend_pct > self.avg_pct + TREND_THRESHOLD:
+            return "improving"
+        if self.trend_pct < self.avg_pct - TREND_THRESHOLD:
+            return "slipping"
+        return "steady"
+
+
+def normalize_answer(text: str) -> str:
+    return " ".join(text.casefold().split())
+
+
+class Question:
+    """A quiz question with its accepted answers normalized/compiled once, up front."""
+    __slots__ = ("id", "topic", "difficulty", "text", "answer", "_accepted", "_patterns")
+
+    def __init__(self, id: int, topic: str, difficulty: int, text: str, answer: str, alternatives: str = ""):
+        self.id = id
+        self.topic = topic
+        self.difficulty = difficulty
+        self.text = text
+        self.answer = answer
+        self._accepted = {normalize_answer(answer)}
+        self._patterns = []
+        for alt in filter(None, (a.strip() for a in alternatives.split("|"))):
+            if alt.startswith("re:"):
+                self._patterns.append(re.compile(alt[3:], re.IGNORECASE))
+            else:
+                self._accepted.add(normalize_answer(alt))
+
+    def check(self, given: str) -> bool:
+        given = normalize_answer(given)
+        return given in self._accepted or any(p.fullmatch(given) for p in self._patterns)
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of long-lived SQLite connections.
+    Connections are created lazily up to `size` and handed out one thread at a time.
+    """
+    def __init__(self, factory, size: int = POOL_SIZE):
+        self._factory = factory
+        self._size = size
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._all: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._all) < self._size:
+                conn = self._factory()
+                self._all.append(conn)
+                return conn
+        return self._idle.get()
+
+    def release(self, conn: sqlite3.Connection):
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        with self._lock:
+            for conn in self._all:
+                conn.close()
+            self._all.clear()
+        self._idle = queue.LifoQueue()
+
+
+class WriteBuffer:
+    """
+    Group commit for inserts. A background thread collects queued rows and writes them
+    with executemany in a single transaction every `interval_ms` or every `max_rows` rows,
+    so a burst of inserts shares one commit (and one fsync) instead of paying one each.
+    on_commit callbacks run after the row is durable: callback(None), or callback(error)
+    if the batch failed. Storage runs its writer with synchronous=FULL while buffering so that
+    each commit is fsynced (the WAL default, NORMAL, can lose the last commits on power loss).
+    """
+    def __init__(self, write, interval_ms: int = WRITE_BUFFER_INTERVAL_MS,
+                 max_rows: int = WRITE_BUFFER_MAX_ROWS):
+        self._write = write  # context manager yielding the writer connection
+        self.interval = interval_ms / 1000
+        self.max_rows = max_rows
+        self.pending = 0
+        self._pending_lock = threading.Lock()
+        self._queue: "queue.Queue" = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="studentverse-write-buffer", daemon=True)
+        self._thread.start()
+
+    def put(self, sql: str, params: tuple, on_commit=None):
+        if self._closed:
+            raise RuntimeError("write buffer is closed")
+        with self._pending_lock:
+            self.pending += 1
+        self._queue.put((sql, params, on_commit))
+
+    def flush(self):
+        """Block until everything queued so far is committed."""
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            batch, waiters, stop = [], [], False
+            item = self._queue.get()
+            deadline = time.monotonic() + self.interval
+            while True:
+                if item is None:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    batch.append(item)
+                if stop or waiters or len(batch) >= self.max_rows:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if batch:
+                self._commit(batch)
+            for done in waiters:
+                done.set()
+            if stop:
+                return
+
+    def _commit(self, batch: list):
+        by_sql: dict = {}
+        for sql, params, _ in batch:
+            by_sql.setdefault(sql, []).append(params)
+        error = None
+        with self._write() as conn:
+            try:
+                conn.execute("BEGIN")
+                for sql, rows in by_sql.items():
+                    conn.executemany(sql, rows)
+                conn.execute("COMMIT")
+            except Exception as e:
+                conn.execute("ROLLBACK")
+                error = e
+        with self._pending_lock:
+            self.pending -= len(batch)
+        for _, _, on_commit in batch:
+            if on_commit is not None:
+                try:
+                    on_commit(error)
+                except Exception:
+                    traceback.print_exc()  # a bad callback must not kill the writer thread
+
+
+class HistoryCache:
+    """
+    LRU of the newest rows of per-user histories, keyed by (table, user_id). Each entry holds
+    up to `max_rows` rows as (id, created_at, *columns), newest first, plus whether that is the
+    whole history. Entries expire after `ttl` seconds and the least recently used one is dropped
+    beyond `max_users`. Storage keeps it current by prepending rows it writes (write-through)
+    and clearing it when `PRAGMA data_version` shows another connection committed. Storage
+    reads data_version on a probe connection of its own, which sees the writer's commits too,
+    so after each of those it moves the baseline on with rebaseline().
+    """
+    def __init__(self, max_users: int = HISTORY_CACHE_USERS, max_rows: int = HISTORY_CACHE_ROWS,
+                 ttl: float = HISTORY_CACHE_TTL):
+        self.max_users = max_users
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0    # bumped by every change, so a read that raced a write isn't cached
+        self.data_version = None
+        self._entries: "OrderedDict[tuple, list]" = OrderedDict()  # key -> [rows, complete, expires_at]
+        self._lock = threading.Lock()
+
+    def _lookup(self, key: tuple) -> Optional[list]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[2] <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def rows(self, key: tuple) -> Optional[List[tuple]]:
+        """The whole history, or None unless all of it is cached."""
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None or not entry[1]:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return list(entry[0])
+
+    def page(self, key: tuple, limit: int, cursor: Optional[Cursor]) -> Optional[List[tuple]]:
+        """Up to limit + 1 rows after `cursor` (as _history_page fetches them), or None if not cached."""
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is not None:
+                rows, complete = entry[0], entry[1]
+                start = 0
+                if cursor is not None:
+                    cursor = tuple(cursor)
+                    while start < len(rows) and (rows[start][1], rows[start][0]) >= cursor:
+                        start += 1
+                chunk = rows[start:start + limit + 1]
+                if len(chunk) > limit or complete:
+                    self.hits += 1
+                    return chunk
+            self.misses += 1
+            return None
+
+    def put(self, key: tuple, rows: List[tuple], complete: bool, generation: int):
+        """Cache rows read from the database, unless anything changed since `generation` was taken."""
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[key] = [rows[:self.max_rows], complete and len(rows) <= self.max_rows,
+                                  time.monotonic() + self.ttl]
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+
+    def prepend(self, key: tuple, row: tuple):
+        """Write-through for a row just committed: it is the newest one in its history."""
+        with self._lock:
+            self.generation += 1
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[0].insert(0, row)
+                if len(entry[0]) > self.max_rows:
+                    entry[0].pop()
+                    entry[1] = False
+
+    def discard(self, key: tuple):
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def validate(self, data_version: int):
+        """Clear everything if the database changed under us since the last check."""
+        with self._lock:
+            if data_version != self.data_version:
+                if self.data_version is not None:
+                    self.generation += 1
+                    self._entries.clear()
+                self.data_version = data_version
+
+    def rebaseline(self, before: int, after: int, foreign: bool):
+        """
+        Our own commit moved data_version from `before` to `after`: adopt `after`. Clear
+        everything first if another connection also committed, during the write (`foreign`)
+        or before it, unvalidated (`before` isn't the baseline).
+        """
+        with self._lock:
+            if foreign or before != self.data_version:
+                self.generation += 1
+                self._entries.clear()
+            self.data_version = after
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
 class Storage:
-    def __init__(self, db_path: str = DB_NAME):
+    """
+    SQLite storage with long-lived connections.
+    All writes go through one writer connection (SQLite allows a single writer anyway);
+    reads use a pool of reader connections and, thanks to WAL, never wait on the writer.
+    Recent notes, plans and quiz scores are served from a HistoryCache (cache_size=0 turns it off).
+    """
+    def __init__(self, db_path: str = DB_NAME, pool_size: int = POOL_SIZE,
+                 hasher: Optional[HashingService] = None, buffered_writes: bool = False,
+                 profiler: Optional[Profiler] = None, cache_size: int = HISTORY_CACHE_USERS):
         self.db_path = Path(db_path)
+        self.archive_path = self.db_path.with_suffix(ARCHIVE_SUFFIX)
+        self.hasher = hasher
+        self.profiler = profiler
+        if profiler is not None:
+            profiler.instrument(self, [name for name, attr in vars(Storage).items()
+                                       if inspect.isfunction(attr) and not name.startswith("_") and name != "close"])
+        self._sessions: "OrderedDict[str, tuple]" = OrderedDict()  # token_hash -> (user_id, username, trusted_until)
+        self._sessions_lock = threading.Lock()
+        self._leaderboards: dict = {}  # (board, k) -> (rows, fresh_until)
+        self._cache = HistoryCache(cache_size) if cache_size > 0 else None
+        self._write_lock = threading.Lock()
+        self._writer = self._connect()
+        self._probe = None  # data_version checks for the cache, off the writer and its lock
+        self._probe_lock = threading.Lock()
+        if self._cache is not None:
+            self._probe = sqlite3.connect(str(self.db_path), isolation_level=None, check_same_thread=False)
+        self._readers = ConnectionPool(self._connect, pool_size)
         self._ensure_db()
+        self._buffer = None
+        self.hash_params = self.get_meta("pw_params", DEFAULT_HASH_PARAMS)
+        if buffered_writes:
+            self._writer.execute("PRAGMA synchronous=FULL")  # on_commit promises durability
+            self._buffer = WriteBuffer(self._write)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.db_path), timeout=10, isolation_level=None,
+                               check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KIB}")
+        conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+        conn.create_function("unzip_note", 1, unzip_note, deterministic=True)
+        conn.execute("ATTACH DATABASE ? AS archive", (str(self.archive_path),))
+        conn.execute("PRAGMA archive.journal_mode=WAL")
+        conn.execute("PRAGMA archive.synchronous=NORMAL")
+        conn.execute(NOTES_ALL_VIEW)
+        if self.profiler is not None:
+            self.profiler.connection_opened(conn)
+        return conn
+
+    @contextmanager
+    def _read(self):
+        if self._buffer is not None and self._buffer.pending:
+            self._buffer.flush()  # read-your-writes
+        with self._readers.connection() as conn:
+            try:
+                yield conn
+            finally:
+                if self.profiler is not None:
+                    self.profiler.statement_done(conn)
+
+    @contextmanager
+    def _write(self):
+        with self._write_lock:
+            if self._probe is not None:
+                # the writer's own data_version moves only for other connections' commits, so it
+                # catches one landing between the probe reads and our commit
+                foreign = self._writer.execute("PRAGMA data_version").fetchone()[0]
+                before, changes = self._data_version(), self._writer.total_changes
+            try:
+                yield self._writer
+            finally:
+                if self.profiler is not None:
+                    self.profiler.statement_done(self._writer)
+                if self._probe is not None and self._writer.total_changes != changes:
+                    during = self._writer.execute("PRAGMA data_version").fetchone()[0] != foreign
+                    self._cache.rebaseline(before, self._data_version(), during)  # our rows reach the cache directly
+
+    def _insert(self, sql: str, params: tuple, on_commit=None, history: Optional[Tuple[tuple, tuple]] = None):
+        """
+        Insert through the write buffer when enabled, else commit right away.
+        `history` is ((table, user_id), (created_at, *columns)) for a history row: its
+        cache key and the row as reads return it, minus the id.
+        """
+        if self._buffer is not None:
+            if history is not None and self._cache is not None:
+                self._cache.discard(history[0])  # the id isn't known until the batch commits
+            self._buffer.put(sql, params, on_commit)
+            return
+        with self._write() as conn:
+            row_id = conn.execute(sql, params).lastrowid
+            if history is not None and self._cache is not None:
+                self._cache.prepend(history[0], (row_id,) + history[1])
+        if on_commit is not None:
+            on_commit(None)
 
-    def _connect(self):
-        return sqlite3.connect(str(self.db_path), timeout=10, isolation_level=None)
+    def flush(self):
+        if self._buffer is not None:
+            self._buffer.flush()
+
+    def _data_version(self) -> int:
+        with self._probe_lock:
+            return self._probe.execute("PRAGMA data_version").fetchone()[0]
+
+    def _validate_cache(self):
+        """
+        Clear the cache if another connection (another process, usually) committed since the
+        last check. _write moves the baseline past our own commits, whose rows reach the cache directly.
+        """
+        self._cache.validate(self._data_version())
+
+    def cache_stats(self) -> Optional[dict]:
+        """Hit/miss counters of the history cache, None when it is off."""
+        return self._cache.stats() if self._cache is not None else None
+
+    def close(self):
+        if self._buffer is not None:
+            self._buffer.close()
+        self._readers.close()
+        with self._write_lock:
+            self._writer.close()
+        if self._probe is not None:
+            with self._probe_lock:
+                self._probe.close()
 
     def _ensure_db(self):
-        conn = self._connect()
-        try:
+        with self._write() as conn:
             cur = conn.cursor()
             cur.execute("""
             CREATE TABLE IF NOT EXISTS users (
@@ -136,133 +1348,1306 @@ class Storage:
                 FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
             );
             """)
-        finally:
-            conn.close()
+            self._migrate(conn)
+            conn.executescript(ARCHIVE_SCHEMA)
+            conn.executescript(ZIPPED_NOTES_FTS)
+            self._backfill_notes_fts(conn)
+
+    def _migrate(self, conn: sqlite3.Connection):
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, script in enumerate(MIGRATIONS[version:], start=version + 1):
+            conn.executescript(f"BEGIN; {script}; PRAGMA user_version = {number}; COMMIT;")
+
+    def _backfill_notes_fts(self, conn: sqlite3.Connection, batch: int = FTS_BACKFILL_BATCH):
+        """
+        Index notes written before full-text search existed, newest first, one batch per
+        transaction. Progress lives in meta so an interrupted backfill resumes where it stopped.
+        """
+        while True:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'notes_fts_backfill_upto'").fetchone()
+            if row is None:
+                return
+            upto = row[0]
+            conn.execute("BEGIN")
+            try:
+                if upto > 0:
+                    conn.execute("INSERT INTO notes_fts (rowid, note, user_id) "
+                                 "SELECT id, note, user_id FROM notes_text WHERE id BETWEEN ? AND ?",
+                                 (upto - batch + 1, upto))
+                if upto - batch > 0:
+                    conn.execute("UPDATE meta SET value = ? WHERE key = 'notes_fts_backfill_upto'", (upto - batch,))
+                else:
+                    conn.execute("DELETE FROM meta WHERE key = 'notes_fts_backfill_upto'")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    # Settings (meta table)
+    def get_meta(self, key: str, default=None):
+        with self._read() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key: str, value):
+        with self._write() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def set_hash_params(self, params: str):
+        """Hash parameters for new passwords; older hashes are upgraded on their next login."""
+        derive_key("check", b"\0" * 16, params)  # reject malformed params before saving them
+        self.set_meta("pw_params", params)
+        self.hash_params = params
+
+    # History (keyset pagination + streaming, cached)
+    def _history(self, table: str, columns: str, user_id: int) -> List[tuple]:
+        """A user's whole history, newest first, as (id, created_at, *columns)."""
+        key = (table, user_id)
+        if self._cache is not None:
+            self._validate_cache()
+            rows = self._cache.rows(key)
+            if rows is not None:
+                return rows
+            generation = self._cache.generation
+        with self._read() as conn:
+            rows = conn.execute(f"SELECT id, created_at, {columns} FROM {table} WHERE user_id = ? "
+                                f"ORDER BY created_at DESC, id DESC", (user_id,)).fetchall()
+        if self._cache is not None:
+            self._cache.put(key, rows, True, generation)
+        return rows
+
+    def _history_page(self, table: str, columns: str, user_id: int, limit: int,
+                      cursor: Optional[Cursor]) -> Tuple[List[tuple], Optional[Cursor]]:
+        """
+        One page of a user's history, newest first, plus the cursor for the next page
+        (None when this was the last page). Rows are (id, created_at, *columns).
+        A first-page miss reads HISTORY_CACHE_ROWS rows so later pages come from the cache.
+        """
+        key, rows = (table, user_id), None
+        if self._cache is not None:
+            self._validate_cache()
+            rows = self._cache.page(key, limit, cursor)
+            generation = self._cache.generation
+        if rows is None:
+            fetch = limit if cursor is not None or self._cache is None else max(limit, self._cache.max_rows)
+            with self._read() as conn:
+                if cursor is None:
+                    rows = conn.execute(f"SELECT id, created_at, {columns} FROM {table} WHERE user_id = ? "
+                                        f"ORDER BY created_at DESC, id DESC LIMIT ?",
+                                        (user_id, fetch + 1)).fetchall()
+                else:
+                    rows = conn.execute(f"SELECT id, created_at, {columns} FROM {table} WHERE user_id = ? "
+                                        f"AND (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT ?",
+                                        (user_id, cursor[0], cursor[1], fetch + 1)).fetchall()
+            if fetch > limit:
+                self._cache.put(key, rows, len(rows) <= fetch, generation)
+                rows = rows[:limit + 1]
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            return rows, (last[1], last[0])
+        return rows, None
+
+    def _history_stream(self, table: str, columns: str, user_id: int, batch: int = STREAM_BATCH):
+        """Yield a user's whole history newest first, holding at most one batch in memory."""
+        cursor = None
+        while True:
+            rows, cursor = self._history_page(table, columns, user_id, batch, cursor)
+            yield from rows
+            if cursor is None:
+                return
 
     # Users
     def create_user(self, username: str, password: str) -> bool:
-        salt_hex, hash_hex = hash_password(password)
+        params = self.hash_params
+        if self.hasher is not None:
+            salt_hex, hash_hex = self.hasher.hash_password(password, None, params).result()
+        else:
+            salt_hex, hash_hex = hash_password(password, None, params)
         created_at = now_iso()
-        conn = self._connect()
         try:
-            cur = conn.cursor()
-            cur.execute("INSERT INTO users (username, pw_salt, pw_hash, created_at) VALUES (?, ?, ?, ?)",
-                        (username, salt_hex, hash_hex, created_at))
+            with self._write() as conn:
+                conn.execute("INSERT INTO users (username, pw_salt, pw_hash, pw_params, created_at) VALUES (?, ?, ?, ?, ?)",
+                             (username, salt_hex, hash_hex, params, created_at))
             return True
         except sqlite3.IntegrityError:
             return False
-        finally:
-            conn.close()
 
-    def get_user(self, username: str) -> Optional[Tuple[int, str, str, str]]:
-        conn = self._connect()
-        try:
-            cur = conn.cursor()
-            cur.execute("SELECT id, username, pw_salt, pw_hash FROM users WHERE username = ?", (username,))
-            row = cur.fetchone()
+    def get_user(self, username: str) -> Optional[Tuple[int, str, str, str, str]]:
+        with self._read() as conn:
+            row = conn.execute("SELECT id, username, pw_salt, pw_hash, pw_params FROM users WHERE username = ?",
+                               (username,)).fetchone()
             if row:
-                return row  # (id, username, pw_salt, pw_hash)
+                return row  # (id, username, pw_salt, pw_hash, pw_params)
             return None
-        finally:
-            conn.close()
+
+    def update_password_hash(self, user_id: int, salt_hex: str, hash_hex: str, params: str):
+        with self._write() as conn:
+            conn.execute("UPDATE users SET pw_salt = ?, pw_hash = ?, pw_params = ? WHERE id = ?",
+                         (salt_hex, hash_hex, params, user_id))
+
+    def add_user_stubs(self, users: Iterable[Tuple[int, str, str]]) -> int:
+        """
+        Record (id, username, created_at) of users that live in a shard directory, without
+        credentials, so joins on users (leaderboards) work in this shard.
+        """
+        return self._insert_many("INSERT OR IGNORE INTO users (id, username, pw_salt, pw_hash, created_at) "
+                                 "VALUES (?, ?, '', '', ?)", users)
+
+    # Sessions
+    def create_session(self, user_id: int, days: int = SESSION_DAYS) -> str:
+        """Start a session and return its token. Only the token's hash is stored."""
+        token = secrets.token_urlsafe(32)
+        with self._write() as conn:
+            conn.execute("DELETE FROM sessions WHERE expires_at < ?", (now_iso(),))  # prune (index range)
+            conn.execute("INSERT INTO sessions (token_hash, user_id, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                         (token_digest(token), user_id, now_iso(), iso_in(days=days)))
+        return token
+
+    def validate_session(self, token: str) -> Optional[Tuple[int, str]]:
+        """(user_id, username) for a live session token, else None. Hits are served from memory."""
+        token_hash = token_digest(token)
+        with self._sessions_lock:
+            cached = self._sessions.get(token_hash)
+            if cached is not None and cached[2] > time.monotonic():
+                self._sessions.move_to_end(token_hash)
+                return cached[0], cached[1]
+        with self._read() as conn:
+            row = conn.execute("SELECT s.user_id, u.username, s.expires_at FROM sessions s "
+                               "JOIN users u ON u.id = s.user_id "
+                               "WHERE s.token_hash = ? AND s.revoked = 0 AND s.expires_at > ?",
+                               (token_hash, now_iso())).fetchone()
+        if row is None:
+            with self._sessions_lock:
+                self._sessions.pop(token_hash, None)
+            return None
+        user_id, username, expires_at = row
+        seconds_left = (datetime.datetime.fromisoformat(expires_at) - datetime.datetime.utcnow()).total_seconds()
+        with self._sessions_lock:
+            self._sessions[token_hash] = (user_id, username, time.monotonic() + min(SESSION_CACHE_TTL, seconds_left))
+            self._sessions.move_to_end(token_hash)
+            while len(self._sessions) > SESSION_CACHE_SIZE:
+                self._sessions.popitem(last=False)
+        return user_id, username
+
+    def revoke_session(self, token: str):
+        token_hash = token_digest(token)
+        with self._sessions_lock:
+            self._sessions.pop(token_hash, None)
+        with self._write() as conn:
+            conn.execute("UPDATE sessions SET revoked = 1 WHERE token_hash = ?", (token_hash,))
+
+    def prune_sessions(self) -> int:
+        """Delete expired and revoked sessions; returns how many were removed. Run at startup."""
+        with self._write() as conn:
+            return conn.execute("DELETE FROM sessions WHERE expires_at < ? OR revoked = 1", (now_iso(),)).rowcount
 
     # Quiz Scores
-    def add_quiz_score(self, user_id: int, score: int, total: int):
-        conn = self._connect()
-        try:
-            cur = conn.cursor()
-            cur.execute("INSERT INTO quiz_scores (user_id, score, total, created_at) VALUES (?, ?, ?, ?)",
-                        (user_id, score, total, now_iso()))
-        finally:
-            conn.close()
+    def add_quiz_score(self, user_id: int, score: int, total: int, on_commit=None):
+        created_at = now_iso()
+        self._insert("INSERT INTO quiz_scores (user_id, score, total, created_at) VALUES (?, ?, ?, ?)",
+                     (user_id, score, total, created_at), on_commit,
+                     (("quiz_scores", user_id), (created_at, score, total)))
+        self._leaderboards.clear()
 
     def get_quiz_scores_for_user(self, user_id: int) -> List[Tuple[int, int, str]]:
-        conn = self._connect()
-        try:
-            cur = conn.cursor()
-            cur.execute("SELECT score, total, created_at FROM quiz_scores WHERE user_id = ? ORDER BY created_at DESC", (user_id,))
-            return cur.fetchall()
-        finally:
-            conn.close()
+        return [(score, total, created_at)
+                for _, created_at, score, total in self._history("quiz_scores", "score, total", user_id)]
+
+    def get_quiz_scores_page(self, user_id: int, limit: int = PAGE_SIZE, cursor: Optional[Cursor] = None
+                             ) -> Tuple[List[Tuple[int, int, str]], Optional[Cursor]]:
+        rows, next_cursor = self._history_page("quiz_scores", "score, total", user_id, limit, cursor)
+        return [(score, total, created_at) for _, created_at, score, total in rows], next_cursor
+
+    def iter_quiz_scores_for_user(self, user_id: int):
+        for _, created_at, score, total in self._history_stream("quiz_scores", "score, total", user_id):
+            yield score, total, created_at
+
+    def get_progress(self, user_id: int) -> Optional["ProgressStats"]:
+        """Summary statistics for a user, read from the trigger-maintained quiz_stats row."""
+        with self._read() as conn:
+            row = conn.execute("SELECT attempts, pct_sum / attempts, best_score, best_total, best_pct, "
+                               "last_pct, ema_pct, last_at FROM quiz_stats WHERE user_id = ?",
+                               (user_id,)).fetchone()
+        return ProgressStats(*row) if row else None
+
+    def get_weekly_progress(self, user_id: int, weeks: int = PROGRESS_WEEKS) -> List[Tuple[str, int, float, float]]:
+        """(week, attempts, avg_pct, best_pct) for the most recent `weeks` weeks with attempts."""
+        with self._read() as conn:
+            return conn.execute("SELECT week, attempts, pct_sum / attempts, best_pct FROM quiz_weekly "
+                                "WHERE user_id = ? ORDER BY week DESC LIMIT ?", (user_id, weeks)).fetchall()
+
+    def get_leaderboard(self, board: str = "best", k: int = LEADERBOARD_SIZE) -> List[Tuple[int, str, float, int]]:
+        """
+        Top-k users as (user_id, username, pct, attempts), board "best" or "average".
+        Reads k rows off a quiz_stats index; results are cached for LEADERBOARD_TTL seconds.
+        """
+        cached = self._leaderboards.get((board, k))
+        if cached is not None and cached[1] > time.monotonic():
+            return cached[0]
+        expr, where = LEADERBOARD_ORDER[board]
+        with self._read() as conn:
+            rows = conn.execute(f"SELECT s.user_id, u.username, {expr}, s.attempts FROM quiz_stats s "
+                                f"JOIN users u ON u.id = s.user_id WHERE 1 {where} "
+                                f"ORDER BY {expr} DESC, s.user_id LIMIT ?", (k,)).fetchall()
+        self._leaderboards[(board, k)] = (rows, time.monotonic() + LEADERBOARD_TTL)
+        return rows
+
+    def get_rank(self, user_id: int, board: str = "best") -> Optional[int]:
+        """1-based position of a user on a board (ties share a rank), None if not on it."""
+        pct = self.get_board_pct(user_id, board)
+        return None if pct is None else self.count_above(pct, board) + 1
+
+    def get_board_pct(self, user_id: int, board: str = "best") -> Optional[float]:
+        """The percentage a user is ranked by on a board, None if not on it."""
+        expr, where = LEADERBOARD_ORDER[board]
+        with self._read() as conn:
+            row = conn.execute(f"SELECT {expr} FROM quiz_stats WHERE user_id = ? {where}", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def count_above(self, pct: float, board: str = "best") -> int:
+        """How many users rank strictly above `pct` on a board (an index range count)."""
+        expr, where = LEADERBOARD_ORDER[board]
+        with self._read() as conn:
+            return conn.execute(f"SELECT COUNT(*) FROM quiz_stats WHERE {expr} > ? {where}", (pct,)).fetchone()[0]
 
     # Notes
-    def add_note(self, user_id: int, note: str):
-        conn = self._connect()
-        try:
-            cur = conn.cursor()
-            cur.execute("INSERT INTO notes (user_id, note, created_at) VALUES (?, ?, ?)",
-                        (user_id, note, now_iso()))
-        finally:
-            conn.close()
+    def add_note(self, user_id: int, note: str, on_commit=None):
+        created_at = now_iso()
+        text, packed = pack_note(note)
+        self._insert("INSERT INTO notes (user_id, note, note_z, created_at) VALUES (?, ?, ?, ?)",
+                     (user_id, text, packed, created_at), on_commit, (("notes_all", user_id), (created_at, note)))
 
+    # notes_all spans the hot and archive tiers
     def get_notes_for_user(self, user_id: int) -> List[Tuple[str, str]]:
-        conn = self._connect()
-        try:
-            cur = conn.cursor()
-            cur.execute("SELECT note, created_at FROM notes WHERE user_id = ? ORDER BY created_at DESC", (user_id,))
-            return cur.fetchall()
-        finally:
-            conn.close()
+        return [(note, created_at) for _, created_at, note in self._history("notes_all", "note", user_id)]
+
+    def get_notes_page(self, user_id: int, limit: int = PAGE_SIZE, cursor: Optional[Cursor] = None
+                       ) -> Tuple[List[Tuple[str, str]], Optional[Cursor]]:
+        rows, next_cursor = self._history_page("notes_all", "note", user_id, limit, cursor)
+        return [(note, created_at) for _, created_at, note in rows], next_cursor
+
+    def iter_notes_for_user(self, user_id: int):
+        for _, created_at, note in self._history_stream("notes_all", "note", user_id):
+            yield note, created_at
+
+    def search_notes(self, user_id: int, query: str, limit: int = PAGE_SIZE, offset: int = 0,
+                     highlight: Tuple[str, str] = ("[", "]")) -> List[Tuple[str, str]]:
+        """
+        Full-text search in one user's notes, hot and archived, best bm25 match first.
+        Returns (snippet, created_at) with matched terms wrapped in `highlight`.
+        Each word must match the note text; a trailing * makes it a prefix match ("pyth*").
+        """
+        match = fts_query(query)
+        if not match:
+            return []
+        # ORDER BY rank lets FTS5 hand rows over in rank order, so only the rows returned
+        # get a snippet (each one may mean decompressing a note)
+        tier = ("SELECT * FROM (SELECT snippet(notes_fts, 0, ?, ?, '...', 16), n.created_at, "
+                "notes_fts.rank FROM {schema}.notes_fts JOIN {schema}.notes n ON n.id = notes_fts.rowid "
+                "WHERE notes_fts MATCH ? AND notes_fts.rank MATCH 'bm25(1.0, 0.0)' ORDER BY notes_fts.rank LIMIT ?)")
+        params = (highlight[0], highlight[1], f"user_id : {int(user_id)} AND note : ({match})", limit + offset)
+        with self._read() as conn:
+            rows = conn.execute(f"{tier.format(schema='main')} UNION ALL {tier.format(schema='archive')} "
+                                f"ORDER BY rank LIMIT ? OFFSET ?", params + params + (limit, offset)).fetchall()
+        return [(snippet, created_at) for snippet, created_at, _ in rows]
 
     # Plans
-    def add_plan(self, user_id: int, plan: str):
-        conn = self._connect()
-        try:
-            cur = conn.cursor()
-            cur.execute("INSERT INTO plans (user_id, plan, created_at) VALUES (?, ?, ?)",
-                        (user_id, plan, now_iso()))
-        finally:
-            conn.close()
+    def add_plan(self, user_id: int, plan: str, on_commit=None, plan_date: Optional[datetime.date] = None,
+                 repeat: Optional[str] = None, until: Optional[datetime.date] = None):
+        """A plan, optionally for a day (plan_date) and repeating from it (`repeat`, until `until`)."""
+        if repeat is not None:
+            if repeat not in REPEAT_RULES:
+                raise ValueError(f"unknown repeat rule {repeat!r}; use one of {', '.join(REPEAT_RULES)}")
+            plan_date = plan_date or datetime.date.today()
+        created_at = now_iso()
+        self._insert("INSERT INTO plans (user_id, plan, created_at, plan_date, repeat_rule, repeat_until) "
+                     "VALUES (?, ?, ?, ?, ?, ?)",
+                     (user_id, plan, created_at, plan_date and plan_date.isoformat(), repeat,
+                      until and until.isoformat()),
+                     on_commit, (("plans", user_id), (created_at, plan)))
 
     def get_plans_for_user(self, user_id: int) -> List[Tuple[str, str]]:
-        conn = self._connect()
+        return [(plan, created_at) for _, created_at, plan in self._history("plans", "plan", user_id)]
+
+    def get_plans_page(self, user_id: int, limit: int = PAGE_SIZE, cursor: Optional[Cursor] = None
+                       ) -> Tuple[List[Tuple[str, str]], Optional[Cursor]]:
+        rows, next_cursor = self._history_page("plans", "plan", user_id, limit, cursor)
+        return [(plan, created_at) for _, created_at, plan in rows], next_cursor
+
+    def iter_plans_for_user(self, user_id: int):
+        for _, created_at, plan in self._history_stream("plans", "plan", user_id):
+            yield plan, created_at
+
+    def iter_agenda(self, user_id: int, start: datetime.date, end: datetime.date
+                    ) -> Iterator[Tuple[datetime.date, str, Optional[str]]]:
+        """
+        (day, plan, repeat_rule) for every day in [start, end] a plan falls on, in date order.
+        One-off plans stream off idx_plans_user_date a batch at a time; recurring plans (few)
+        are read up front and expanded lazily by occurrences(), so a long horizon costs no
+        more memory than a short one. Stop iterating whenever enough has been shown.
+        """
+        with self._read() as conn:
+            repeating = conn.execute("SELECT plan_date, id, plan, repeat_rule, repeat_until FROM plans "
+                                     "WHERE user_id = ? AND repeat_rule IS NOT NULL AND plan_date <= ? "
+                                     "AND (repeat_until IS NULL OR repeat_until >= ?)",
+                                     (user_id, end.isoformat(), start.isoformat())).fetchall()
+        streams = [self._repeats(row, start, end) for row in repeating]
+        streams.append(self._dated_plans(user_id, start, end))
+        for day, _, plan, rule in heapq.merge(*streams):
+            yield day, plan, rule
+
+    @staticmethod
+    def _repeats(row: tuple, start: datetime.date, end: datetime.date):
+        plan_date, plan_id, plan, rule, until = row
+        until = datetime.date.fromisoformat(until) if until else None
+        for day in occurrences(datetime.date.fromisoformat(plan_date), rule, until, start, end):
+            yield day, plan_id, plan, rule
+
+    def _dated_plans(self, user_id: int, start: datetime.date, end: datetime.date, batch: int = STREAM_BATCH):
+        """One-off plans dated within [start, end], keyset-paginated on (plan_date, id)."""
+        after = (start.isoformat(), 0)
+        while True:
+            with self._read() as conn:
+                rows = conn.execute("SELECT plan_date, id, plan FROM plans WHERE user_id = ? AND repeat_rule IS NULL "
+                                    "AND (plan_date, id) > (?, ?) AND plan_date <= ? ORDER BY plan_date, id LIMIT ?",
+                                    (user_id, after[0], after[1], end.isoformat(), batch)).fetchall()
+            for plan_date, plan_id, plan in rows:
+                yield datetime.date.fromisoformat(plan_date), plan_id, plan, None
+            if len(rows) < batch:
+                return
+            after = rows[-1][:2]
+
+    # Note tiers (maintenance)
+    def compress_notes(self, batch: int = ARCHIVE_BATCH) -> Tuple[int, int, int]:
+        """
+        Compress hot notes stored as plain text (written before compression existed, or
+        imported) that pack_note would compress now. Returns (notes, bytes_before, bytes_after).
+        """
+        self.flush()
+        last_id, compressed, before, after = 0, 0, 0, 0
+        while True:
+            with self._write() as conn:
+                rows = conn.execute("SELECT id, note FROM notes WHERE id > ? AND note_z IS NULL "
+                                    "AND length(CAST(note AS BLOB)) >= ? ORDER BY id LIMIT ?",
+                                    (last_id, NOTE_COMPRESS_MIN, batch)).fetchall()
+                if not rows:
+                    return compressed, before, after
+                updates = []
+                for note_id, note in rows:
+                    _, packed = pack_note(note)
+                    if packed is not None:
+                        updates.append((packed, note_id))
+                        before += len(note.encode("utf-8"))
+                        after += len(packed)
+                conn.execute("BEGIN")
+                try:
+                    compressed += conn.executemany("UPDATE notes SET note = '', note_z = ? WHERE id = ?",
+                                                   updates).rowcount
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+            last_id = rows[-1][0]
+
+    def archive_notes(self, days: int = ARCHIVE_DAYS, batch: int = ARCHIVE_BATCH) -> int:
+        """
+        Move notes older than `days` days to the archive database, `batch` ids at a time.
+        The copy commits before the originals are deleted (the two files don't share a
+        transaction in WAL mode), so a crash can leave a note in both tiers until the next
+        run finishes the move, but never in neither. Returns the number of notes moved.
+        """
+        self.flush()
+        cutoff = iso_in(days=-days)
+        last_id, moved = 0, 0
+        while True:
+            with self._write() as conn:
+                ids = conn.execute("SELECT id FROM main.notes WHERE id > ? AND created_at < ? ORDER BY id LIMIT ?",
+                                   (last_id, cutoff, batch)).fetchall()
+                if not ids:
+                    return moved
+                span = (ids[0][0], ids[-1][0], cutoff)
+                # compressed rows are indexed here, the archive's triggers only index plain text
+                copy = ("INSERT INTO archive.notes_fts (rowid, note, user_id) "
+                        "SELECT id, unzip_note(note_z), user_id FROM main.notes WHERE id BETWEEN ? AND ? "
+                        "AND created_at < ? AND note_z IS NOT NULL AND id NOT IN (SELECT id FROM archive.notes)",
+                        "INSERT OR IGNORE INTO archive.notes (id, user_id, note, note_z, created_at) "
+                        "SELECT id, user_id, note, note_z, created_at FROM main.notes "
+                        "WHERE id BETWEEN ? AND ? AND created_at < ?")
+                for sqls in (copy, ("DELETE FROM main.notes WHERE id BETWEEN ? AND ? AND created_at < ?",)):
+                    conn.execute("BEGIN")
+                    try:
+                        for sql in sqls:
+                            count = conn.execute(sql, span).rowcount
+                        conn.execute("COMMIT")
+                    except Exception:
+                        conn.execute("ROLLBACK")
+                        raise
+                moved += count
+            last_id = ids[-1][0]
+
+    def tier_stats(self) -> dict:
+        """Note counts and bytes in use (allocated pages minus free pages) per tier."""
+        stats = {}
+        with self._read() as conn:
+            for schema in ("main", "archive"):
+                page_size = conn.execute(f"PRAGMA {schema}.page_size").fetchone()[0]
+                pages = conn.execute(f"PRAGMA {schema}.page_count").fetchone()[0]
+                free = conn.execute(f"PRAGMA {schema}.freelist_count").fetchone()[0]
+                notes = conn.execute(f"SELECT COUNT(*) FROM {schema}.notes").fetchone()[0]
+                stats[schema] = {"notes": notes, "bytes": (pages - free) * page_size}
+        return stats
+
+    # Bulk import / export
+    def export_rows(self, table: str, batch: int = STREAM_BATCH) -> Iterator[tuple]:
+        """Stream a whole table in id order, `batch` rows per fetchmany (notes: both tiers, decompressed)."""
+        columns = EXPORT_TABLES[table]
+        source = "notes_all" if table == "notes" else table
+        with self._read() as conn:
+            cur = conn.execute(f"SELECT {', '.join(columns)} FROM {source} ORDER BY id")
+            while True:
+                rows = cur.fetchmany(batch)
+                if not rows:
+                    return
+                yield from rows
+
+    def import_rows(self, table: str, rows: Iterable[tuple], batch: int = IMPORT_BATCH,
+                    user_ids: Optional[dict] = None) -> int:
+        """
+        Insert rows (tuples in EXPORT_TABLES order) in chunks, one transaction per chunk; returns
+        rows inserted. Users are matched by username: existing ones are left alone, the rest get
+        new ids, recorded in `user_ids` (exported id -> local id). Rows of USER_TABLES drop their
+        exported ids and take their owner's local id from `user_ids`; rows of users that weren't
+        imported are skipped. Questions clashing with an existing id are skipped.
+        """
+        if table == "users":
+            return self._import_users(rows, {} if user_ids is None else user_ids, batch)
+        columns = EXPORT_TABLES[table]
+        if table in USER_TABLES:
+            if user_ids is None:
+                raise ValueError(f"importing {table} needs the user ids from importing users first")
+            columns = columns[1:]
+            rows = remap_user_rows(rows, user_ids)
+        return self._insert_many(f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) "
+                                 f"VALUES ({', '.join('?' * len(columns))})", rows, batch)
+
+    def _import_users(self, rows: Iterable[tuple], user_ids: dict, batch: int) -> int:
+        self.flush()
+        rows = iter(rows)
+        inserted = 0
+        while True:
+            chunk = list(islice(rows, batch))
+            if not chunk:
+                return inserted
+            added = {}
+            with self._write() as conn:
+                conn.execute("BEGIN")
+                try:
+                    taken = {name for (name,) in conn.execute(
+                        "SELECT username FROM users WHERE username IN (SELECT value FROM json_each(?))",
+                        (json.dumps([row[1] for row in chunk]),))}
+                    for old_id, username, *rest in chunk:
+                        if username in taken:
+                            continue
+                        taken.add(username)
+                        added[int(old_id)] = conn.execute(
+                            "INSERT INTO users (username, pw_salt, pw_hash, pw_params, created_at) "
+                            "VALUES (?, ?, ?, ?, ?)", (username, *rest)).lastrowid
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+            user_ids.update(added)
+            inserted += len(added)
+
+    def _insert_many(self, sql: str, rows: Iterable[tuple], batch: int = IMPORT_BATCH) -> int:
+        self.flush()
+        rows = iter(rows)
+        inserted = 0
+        while True:
+            chunk = list(islice(rows, batch))
+            if not chunk:
+                return inserted
+            with self._write() as conn:
+                conn.execute("BEGIN")
+                try:
+                    inserted += conn.executemany(sql, chunk).rowcount
+                    conn.execute("COMMIT")
+                    if self._cache is not None:
+                        self._cache.clear()  # bulk rows bypass write-through
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+
+
+    # Question bank
+    def add_questions(self, rows: Iterable[tuple], batch: int = IMPORT_BATCH) -> int:
+        """Bulk-load (topic, difficulty, question, answer, alternatives) rows; returns rows added."""
+        return self._insert_many(f"INSERT INTO questions ({', '.join(QUESTION_COLUMNS)}) VALUES (?, ?, ?, ?, ?)",
+                                 rows, batch)
+
+    def get_question_topics(self) -> List[str]:
+        """Distinct topics via an index skip-scan: one seek per topic, not one row per question."""
+        with self._read() as conn:
+            return [t for (t,) in conn.execute(
+                "WITH RECURSIVE t(topic) AS ("
+                "  SELECT MIN(topic) FROM questions"
+                "  UNION ALL SELECT (SELECT MIN(topic) FROM questions WHERE topic > t.topic) FROM t"
+                "  WHERE t.topic IS NOT NULL"
+                ") SELECT topic FROM t WHERE topic IS NOT NULL")]
+
+    def sample_questions(self, count: int, topic: Optional[str] = None,
+                         difficulty: Optional[int] = None) -> Iterator[Question]:
+        """
+        Yield up to `count` distinct random questions, each read only when the caller asks for it.
+        Small sets are sampled from their full id list; large ones by drawing random ranks and
+        seeking each with OFFSET on the (topic, difficulty, id) index, which walks index entries
+        only and gives every matching question the same chance whatever gaps the ids have.
+        """
+        where, params = ["1"], []
+        if topic is not None:
+            where.append("topic = ?")
+            params.append(topic)
+        if difficulty is not None:
+            where.append("difficulty = ?")
+            params.append(difficulty)
+        where = " AND ".join(where)
+        columns = "id, topic, difficulty, question, answer, alternatives"
+        with self._read() as conn:
+            (total,) = conn.execute(f"SELECT COUNT(*) FROM questions WHERE {where}", params).fetchone()
+            if total <= SMALL_BANK:
+                ids = [i for (i,) in conn.execute(f"SELECT id FROM questions WHERE {where}", params)]
+                pick = f"SELECT {columns} FROM questions WHERE id = ?"
+                candidates = [(pick, (i,)) for i in random.sample(ids, min(count, len(ids)))]
+        if total > SMALL_BANK:
+            seek = (f"SELECT {columns} FROM questions WHERE id = "
+                    f"(SELECT id FROM questions WHERE {where} ORDER BY id LIMIT 1 OFFSET ?)")
+            candidates = ((seek, params + [rank]) for rank in random.sample(range(total), min(count, total)))
+        seen = set()
+        for query, args in candidates:
+            with self._read() as conn:
+                row = conn.execute(query, args).fetchone()
+            if row is None or row[0] in seen:  # deleted since it was counted
+                continue
+            seen.add(row[0])
+            yield Question(*row)
+            if len(seen) == count:
+                return
+
+
+# ------------------ SHARDING ------------------
+
+def shard_of(user_id: int, shards: int) -> int:
+    """Stable shard index of a user: CRC-32 of the id, the same in every process and run."""
+    return zlib.crc32(str(user_id).encode()) % shards
+
+
+def shard_path(db_path, index: int, shards: int) -> Path:
+    """File of one shard; a single shard is the directory database itself."""
+    db_path = Path(db_path)
+    return db_path if shards == 1 else db_path.with_suffix(SHARD_SUFFIX.format(index=index))
+
+
+def _on_directory(name: str):
+    def method(self, *args, **kwargs):
+        return getattr(self.directory, name)(*args, **kwargs)
+    method.__name__, method.__doc__ = name, getattr(Storage, name).__doc__
+    return method
+
+
+def _on_user_shard(name: str):
+    def method(self, user_id: int, *args, **kwargs):
+        return getattr(self.shard(user_id), name)(user_id, *args, **kwargs)
+    method.__name__, method.__doc__ = name, getattr(Storage, name).__doc__
+    return method
+
+
+class ShardedStorage:
+    """
+    Storage spread over several SQLite files, so writers for different users don't queue
+    on one lock. The directory database (the usual db file) owns users, sessions, settings
+    and the question bank; a user's notes, plans and scores live in shard shard_of(user_id).
+    Every shard also holds a credential-less copy of its users' rows for leaderboard joins.
+    Leaderboards and ranks gather the top k / counts of every shard. Same interface as Storage;
+    use open_storage() to get whichever the database is set up for.
+    """
+    def __init__(self, directory: Storage, shards: int, **options):
+        self.directory = directory
+        self.shards = [Storage(str(shard_path(directory.db_path, i, shards)), **options) for i in range(shards)]
+        self.archive_path = directory.db_path.with_suffix(SHARD_SUFFIX.format(index="*") + ARCHIVE_SUFFIX)
+
+    def shard(self, user_id: int) -> Storage:
+        return self.shards[shard_of(user_id, len(self.shards))]
+
+    @property
+    def hasher(self):
+        return self.directory.hasher
+
+    @property
+    def hash_params(self) -> str:
+        return self.directory.hash_params
+
+    def flush(self):
+        for shard in self.shards:
+            shard.flush()
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        self.directory.close()
+
+    def cache_stats(self) -> Optional[dict]:
+        stats = [shard.cache_stats() for shard in self.shards]
+        if stats[0] is None:
+            return None
+        return {key: sum(s[key] for s in stats) for key in stats[0]}
+
+    # Directory: settings, users, sessions, question bank
+    get_meta = _on_directory("get_meta")
+    set_meta = _on_directory("set_meta")
+    set_hash_params = _on_directory("set_hash_params")
+    get_user = _on_directory("get_user")
+    update_password_hash = _on_directory("update_password_hash")
+    create_session = _on_directory("create_session")
+    validate_session = _on_directory("validate_session")
+    revoke_session = _on_directory("revoke_session")
+    prune_sessions = _on_directory("prune_sessions")
+    add_questions = _on_directory("add_questions")
+    get_question_topics = _on_directory("get_question_topics")
+    sample_questions = _on_directory("sample_questions")
+
+    def create_user(self, username: str, password: str) -> bool:
+        if not self.directory.create_user(username, password):
+            return False
+        user_id = self.directory.get_user(username)[0]
+        self.shard(user_id).add_user_stubs([(user_id, username, now_iso())])
+        return True
+
+    # Per-user data: the user's shard
+    add_quiz_score = _on_user_shard("add_quiz_score")
+    get_quiz_scores_for_user = _on_user_shard("get_quiz_scores_for_user")
+    get_quiz_scores_page = _on_user_shard("get_quiz_scores_page")
+    iter_quiz_scores_for_user = _on_user_shard("iter_quiz_scores_for_user")
+    get_progress = _on_user_shard("get_progress")
+    get_weekly_progress = _on_user_shard("get_weekly_progress")
+    get_board_pct = _on_user_shard("get_board_pct")
+    add_note = _on_user_shard("add_note")
+    get_notes_for_user = _on_user_shard("get_notes_for_user")
+    get_notes_page = _on_user_shard("get_notes_page")
+    iter_notes_for_user = _on_user_shard("iter_notes_for_user")
+    search_notes = _on_user_shard("search_notes")
+    add_plan = _on_user_shard("add_plan")
+    get_plans_for_user = _on_user_shard("get_plans_for_user")
+    get_plans_page = _on_user_shard("get_plans_page")
+    iter_plans_for_user = _on_user_shard("iter_plans_for_user")
+    iter_agenda = _on_user_shard("iter_agenda")
+
+    # Global reads: scatter-gather
+    def get_leaderboard(self, board: str = "best", k: int = LEADERBOARD_SIZE) -> List[Tuple[int, str, float, int]]:
+        """The global top k is within the union of every shard's (cached) top k."""
+        rows = [row for shard in self.shards for row in shard.get_leaderboard(board, k)]
+        return sorted(rows, key=lambda row: (-row[2], row[0]))[:k]
+
+    def get_rank(self, user_id: int, board: str = "best") -> Optional[int]:
+        pct = self.get_board_pct(user_id, board)
+        return None if pct is None else sum(shard.count_above(pct, board) for shard in self.shards) + 1
+
+    # Maintenance, per shard
+    def compress_notes(self, batch: int = ARCHIVE_BATCH) -> Tuple[int, int, int]:
+        totals = [shard.compress_notes(batch) for shard in self.shards]
+        return tuple(sum(column) for column in zip(*totals))
+
+    def archive_notes(self, days: int = ARCHIVE_DAYS, batch: int = ARCHIVE_BATCH) -> int:
+        return sum(shard.archive_notes(days, batch) for shard in self.shards)
+
+    def tier_stats(self) -> dict:
+        stats = [shard.tier_stats() for shard in self.shards]
+        return {schema: {key: sum(s[schema][key] for s in stats) for key in stats[0][schema]} for schema in stats[0]}
+
+    # Bulk import / export
+    def export_rows(self, table: str, batch: int = STREAM_BATCH) -> Iterator[tuple]:
+        """Like Storage.export_rows. Per-user row ids are per shard, so they are renumbered 1..n
+        across shards; imports give those rows new ids anyway, but the file stays unambiguous."""
+        if table in ("users", "questions"):
+            return self.directory.export_rows(table, batch)
+        rows = chain.from_iterable(shard.export_rows(table, batch) for shard in self.shards)
+        return ((row_id, *row[1:]) for row_id, row in enumerate(rows, 1))
+
+    def import_rows(self, table: str, rows: Iterable[tuple], batch: int = IMPORT_BATCH,
+                    user_ids: Optional[dict] = None) -> int:
+        """Like Storage.import_rows; users go to the directory (and stubs to their shard), their rows to that shard."""
+        if table == "questions":
+            return self.directory.import_rows(table, rows, batch)
+        if user_ids is None:
+            if table != "users":
+                raise ValueError(f"importing {table} needs the user ids from importing users first")
+            user_ids = {}
+        rows = iter(rows)
+        inserted = 0
+        while True:
+            chunk = list(islice(rows, batch))
+            if not chunk:
+                return inserted
+            by_shard: dict = {}
+            if table == "users":
+                added: dict = {}
+                inserted += self.directory.import_rows(table, chunk, batch, added)
+                user_ids.update(added)
+                for old_id, username, _, _, _, created_at in chunk:
+                    user_id = added.get(int(old_id))
+                    if user_id is not None:
+                        by_shard.setdefault(shard_of(user_id, len(self.shards)), []).append(
+                            (user_id, username, created_at))
+                for index, part in by_shard.items():
+                    self.shards[index].add_user_stubs(part)
+                continue
+            for row in chunk:
+                user_id = user_ids.get(int(row[1]))
+                if user_id is not None:
+                    by_shard.setdefault(shard_of(user_id, len(self.shards)), []).append(row)
+            for index, part in by_shard.items():
+                inserted += self.shards[index].import_rows(table, part, batch, user_ids)
+
+
+def open_storage(db_path: str = DB_NAME, **options):
+    """A Storage, or a ShardedStorage when `reshard` has split the database."""
+    directory = Storage(db_path, **options)
+    if directory.get_meta("reshard_to") is not None:
+        directory.close()
+        raise RuntimeError(f"{db_path} is being resharded; run `reshard` again to finish")
+    shards = int(directory.get_meta("shards", 1))
+    return directory if shards == 1 else ShardedStorage(directory, shards, **options)
+
+
+def _delete_user_rows(conn: sqlite3.Connection, user_id: int, with_user: bool):
+    conn.execute("INSERT INTO archive.notes_fts (notes_fts, rowid, note, user_id) SELECT 'delete', id, "
+                 "unzip_note(note_z), user_id FROM archive.notes WHERE user_id = ? AND note_z IS NOT NULL", (user_id,))
+    for table in ("main.notes", "archive.notes", "plans", "quiz_scores", "quiz_stats", "quiz_weekly"):
+        conn.execute(f"DELETE FROM {table} WHERE user_id = ?", (user_id,))
+    if with_user:
+        conn.execute("DELETE FROM users WHERE id = ?", (user_id,))
+
+
+def _move_user(src: Storage, dst: Storage, user: Tuple[int, str, str], directory: Storage):
+    """
+    Copy one user's rows to `dst` (replacing leftovers of an interrupted copy), record the
+    user as done, then delete them from `src`. Archived notes land in dst's hot tier and
+    scores are replayed in order so dst's triggers rebuild quiz_stats and quiz_weekly.
+    """
+    user_id = user[0]
+    with src._read() as conn:
+        notes = conn.execute("SELECT user_id, note, created_at FROM notes_all WHERE user_id = ? "
+                             "ORDER BY created_at, id", (user_id,)).fetchall()
+        copies = {}
+        for table in ("plans", "quiz_scores"):
+            columns = [c[1] for c in conn.execute(f"PRAGMA table_info({table})") if c[1] != "id"]
+            copies[table] = (columns, conn.execute(f"SELECT {', '.join(columns)} FROM {table} WHERE user_id = ? "
+                                                   f"ORDER BY created_at, id", (user_id,)).fetchall())
+    with dst._write() as conn:
+        conn.execute("BEGIN")
         try:
-            cur = conn.cursor()
-            cur.execute("SELECT plan, created_at FROM plans WHERE user_id = ? ORDER BY created_at DESC", (user_id,))
-            return cur.fetchall()
+            _delete_user_rows(conn, user_id, with_user=False)
+            conn.execute("INSERT OR IGNORE INTO users (id, username, pw_salt, pw_hash, created_at) "
+                         "VALUES (?, ?, '', '', ?)", user)
+            conn.executemany("INSERT INTO notes (user_id, note, note_z, created_at) VALUES (?, ?, ?, ?)",
+                             ((uid, *pack_note(note), created_at) for uid, note, created_at in notes))
+            for table, (columns, rows) in copies.items():
+                conn.executemany(f"INSERT INTO {table} ({', '.join(columns)}) "
+                                 f"VALUES ({', '.join('?' * len(columns))})", rows)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    directory.set_meta("reshard_done", user_id)
+    with src._write() as conn:
+        conn.execute("BEGIN")
+        _delete_user_rows(conn, user_id, with_user=src is not directory)
+        conn.execute("COMMIT")
+
+
+def reshard(db_path: str, shards: int, out=None):
+    """
+    Offline rebalancing (stop the app first): move every user whose shard changes to
+    shard_of(user_id, shards), then record the new count. Progress is kept in the
+    directory's meta table, so an interrupted run is finished by running it again.
+    """
+    if shards < 1:
+        raise ValueError("need at least one shard")
+    out = out or sys.stdout
+    directory = Storage(db_path, cache_size=0)
+    opened = {directory.db_path: directory}
+
+    def store(path: Path) -> Storage:
+        if path not in opened:
+            opened[path] = Storage(str(path), cache_size=0)
+        return opened[path]
+
+    try:
+        current = int(directory.get_meta("shards", 1))
+        target = directory.get_meta("reshard_to")
+        if target is not None and int(target) != shards:
+            raise RuntimeError(f"an interrupted reshard to {target} shards must be finished first")
+        if target is None and current == shards:
+            print(f"{db_path} already has {shards} shard(s)", file=out)
+            return
+        directory.set_meta("reshard_to", shards)
+        done = int(directory.get_meta("reshard_done", 0))
+        with directory._read() as conn:
+            users = conn.execute("SELECT id, username, created_at FROM users WHERE id >= ? ORDER BY id",
+                                 (done,)).fetchall()
+        progress = Progress("reshard users", out=out)
+        moved = 0
+        for user in progress.track(users):
+            src = store(shard_path(db_path, shard_of(user[0], current), current))
+            dst = store(shard_path(db_path, shard_of(user[0], shards), shards))
+            if src is dst:
+                continue
+            if user[0] == done:  # copied last time; only the delete may be missing
+                with src._write() as conn:
+                    conn.execute("BEGIN")
+                    _delete_user_rows(conn, user[0], with_user=src is not directory)
+                    conn.execute("COMMIT")
+            else:
+                _move_user(src, dst, user, directory)
+                moved += 1
+        progress.report(extra=f", {moved:,} moved")
+        for index in range(shards):
+            store(shard_path(db_path, index, shards))  # create empty shards too
+        with directory._write() as conn:
+            conn.execute("BEGIN")
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('shards', ?)", (shards,))
+            conn.execute("DELETE FROM meta WHERE key IN ('reshard_to', 'reshard_done')")
+            conn.execute("COMMIT")
+        unused = [str(path) for path in opened
+                  if path not in {shard_path(db_path, i, shards) for i in range(shards)} | {directory.db_path}]
+        if unused:
+            print(f"no longer used (now empty): {', '.join(unused)}", file=out)
+    finally:
+        for storage in opened.values():
+            storage.close()
+
+
+# ------------------ IMPORT / EXPORT ------------------
+
+class Progress:
+    """Counts rows flowing through an iterator and prints a throughput line about once a second."""
+    def __init__(self, label: str, out=sys.stderr, every: float = 1.0):
+        self.label = label
+        self.out = out
+        self.every = every
+        self.rows = 0
+        self.start = time.perf_counter()
+        self._last = self.start
+
+    def track(self, rows: Iterable) -> Iterator:
+        for row in rows:
+            self.rows += 1
+            yield row
+            if self.rows % 1000 == 0 and time.perf_counter() - self._last >= self.every:
+                self._last = time.perf_counter()
+                self.report(end="\r")
+
+    def report(self, end: str = "\n", extra: str = ""):
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        print(f"{self.label}: {self.rows:,} rows in {elapsed:.1f}s ({self.rows / elapsed:,.0f} rows/s){extra}",
+              end=end, file=self.out, flush=True)
+
+
+def data_file(directory: Path, table: str, fmt: str, compress: bool) -> Path:
+    return Path(directory) / f"{table}.{fmt}{'.gz' if compress else ''}"
+
+def open_data_file(path: Path, mode: str):
+    if path.suffix == ".gz":
+        return gzip.open(path, mode + "t", compresslevel=6, encoding="utf-8", newline="")
+    return open(path, mode, encoding="utf-8", newline="")
+
+def write_rows(path: Path, columns: Tuple[str, ...], rows: Iterable[tuple]):
+    """Stream rows to CSV (with a header) or JSONL, chosen by file extension."""
+    with open_data_file(path, "w") as f:
+        if ".csv" in path.suffixes:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                f.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+                f.write("\n")
+
+def read_rows(path: Path, columns: Tuple[str, ...]) -> Iterator[tuple]:
+    """Stream rows back out of a CSV or JSONL file as tuples in `columns` order."""
+    with open_data_file(path, "r") as f:
+        if ".csv" in path.suffixes:
+            for record in csv.DictReader(f):
+                yield tuple(record.get(c) or None if c in OPTIONAL_COLUMNS else record[c] for c in columns)
+        else:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    yield tuple(record.get(c) if c in OPTIONAL_COLUMNS else record[c] for c in columns)
+
+def remap_user_rows(rows: Iterable[tuple], user_ids: dict) -> Iterator[tuple]:
+    """Per-user export rows without their id, user_id mapped through user_ids (unmapped users dropped)."""
+    for row in rows:
+        user_id = user_ids.get(int(row[1]))
+        if user_id is not None:
+            yield (user_id, *row[2:])
+
+def export_data(storage: "Storage", directory: Path, fmt: str = "jsonl", compress: bool = False,
+                tables: Iterable[str] = EXPORT_TABLES):
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    for table in tables:
+        path = data_file(directory, table, fmt, compress)
+        progress = Progress(f"export {table}")
+        write_rows(path, EXPORT_TABLES[table], progress.track(storage.export_rows(table)))
+        progress.report(extra=f" -> {path}")
+
+def load_question_bank(storage: "Storage", path: Path) -> int:
+    """Load a CSV/JSONL question file (columns: topic, difficulty, question, answer, alternatives)."""
+    def rows():
+        with open_data_file(Path(path), "r") as f:
+            records = csv.DictReader(f) if ".csv" in Path(path).suffixes else (json.loads(l) for l in f if l.strip())
+            for r in records:
+                yield (r["topic"].strip().lower(), int(r.get("difficulty") or 1), r["question"], r["answer"],
+                       r.get("alternatives") or "")
+
+    progress = Progress(f"load {Path(path).name}")
+    added = storage.add_questions(progress.track(rows()))
+    progress.report()
+    return added
+
+def import_data(storage: "Storage", directory: Path, tables: Iterable[str] = EXPORT_TABLES):
+    """
+    Import every table file found in `directory`. Users whose username already exists are
+    skipped together with their notes, plans and scores; imported users get new ids and their
+    rows follow them. Per-user tables always bring the users file along, which links them.
+    """
+    tables = set(tables)
+    if tables & set(USER_TABLES):
+        tables.add("users")
+    user_ids: dict = {}
+    for table in (t for t in EXPORT_TABLES if t in tables):
+        candidates = [data_file(directory, table, fmt, gz) for fmt in ("jsonl", "csv") for gz in (False, True)]
+        path = next((c for c in candidates if c.exists()), None)
+        if path is None:
+            if table == "users" and tables & set(USER_TABLES):
+                raise ValueError(f"no users file in {directory}: per-user rows can't be matched to accounts")
+            continue
+        progress = Progress(f"import {table}")
+        inserted = storage.import_rows(table, progress.track(read_rows(path, EXPORT_TABLES[table])),
+                                       user_ids=user_ids)
+        progress.report(extra=f", {inserted:,} new")
+
+
+def archive_data(storage: "Storage", days: int = ARCHIVE_DAYS, out=None):
+    """Compress plain-text notes, move notes older than `days` to the archive tier, report space."""
+    out = out or sys.stdout
+    before = storage.tier_stats()
+    compressed, raw, packed = storage.compress_notes()
+    print(f"compressed {compressed:,} notes: {raw / 1024:,.0f} KiB -> {packed / 1024:,.0f} KiB "
+          f"({(raw - packed) / 1024:,.0f} KiB saved)", file=out)
+    moved = storage.archive_notes(days)
+    print(f"archived {moved:,} notes older than {days} days to {storage.archive_path}", file=out)
+    after = storage.tier_stats()
+    for schema, label in (("main", "hot tier"), ("archive", "archive")):
+        print(f"{label:<9} {before[schema]['notes']:>10,} -> {after[schema]['notes']:>10,} notes   "
+              f"{before[schema]['bytes'] / 1024:>10,.0f} -> {after[schema]['bytes'] / 1024:>10,.0f} KiB in use",
+              file=out)
+
+
+# ------------------ SERVICE (business logic) ------------------
+
+class Service:
+    """
+    Business logic shared by the console app and the network server. Nothing here touches
+    the terminal; calls may block on SQLite or password hashing, so async callers should
+    run them in an executor.
+    """
+    def __init__(self, storage: Storage, hasher: HashingService):
+        self.storage = storage
+        self.hasher = hasher
+
+    # Auth
+    def register(self, username: str, password: str) -> bool:
+        """False if the username is taken. Raises ValueError for empty input."""
+        username = username.strip().lower()
+        if not username or not password:
+            raise ValueError("Username and password cannot be empty.")
+        return self.storage.create_user(username, password)
+
+    def login(self, username: str, password: str) -> Optional[Tuple[int, str, str]]:
+        """(user_id, username, session_token) if the password is right, else None."""
+        username = username.strip().lower()
+        user = self.storage.get_user(username)
+        if user is None:
+            return None
+        user_id, _, pw_salt, pw_hash, pw_params = user
+        if not self.hasher.verify_password(pw_salt, pw_hash, password, pw_params).result():
+            return None
+        if pw_params != self.storage.hash_params:
+            self.rehash_in_background(user_id, password)
+        return user_id, username, self.storage.create_session(user_id)
+
+    def rehash_in_background(self, user_id: int, password: str):
+        """Upgrade an outdated hash to the current parameters without making the login wait."""
+        params = self.storage.hash_params
+
+        def store(future: Future):
+            if future.exception() is None:
+                salt_hex, hash_hex = future.result()
+                self.storage.update_password_hash(user_id, salt_hex, hash_hex, params)
+
+        self.hasher.hash_password(password, None, params).add_done_callback(store)
+
+    def resume(self, token: str) -> Optional[Tuple[int, str]]:
+        return self.storage.validate_session(token)
+
+    def logout(self, token: str):
+        self.storage.revoke_session(token)
+
+    # Quiz
+    def start_quiz(self, count: int = QUIZ_LENGTH, topic: Optional[str] = None,
+                   difficulty: Optional[int] = None) -> List[Question]:
+        return list(self.storage.sample_questions(count, topic, difficulty))
+
+    def finish_quiz(self, user_id: int, questions: List[Question], answers: dict) -> Tuple[int, int, List[bool]]:
+        """Grade answers ({question_id: answer}), record the score, return (score, total, per-question)."""
+        results = [q.check(str(answers.get(q.id, answers.get(str(q.id), "")))) for q in questions]
+        score, total = sum(results), len(questions)
+        self.storage.add_quiz_score(user_id, score, total)
+        return score, total, results
+
+
+# ------------------ NETWORK SERVER ------------------
+
+class Server:
+    """
+    Serves many StudentVerse sessions at once over a JSON-lines TCP protocol.
+    Each request is one line {"op": ..., ...}; each reply is one line {"ok": true, ...}
+    or {"ok": false, "error": ...}. SQLite calls run in a thread pool and PBKDF2 in the
+    HashingService process pool, so the event loop only shuffles bytes.
+
+    ops: register, login, resume, logout, add_note, notes, search, add_plan, plans,
+         agenda, quiz, answer, progress, leaderboard
+    """
+    def __init__(self, service: Service, threads: int = SERVER_THREADS):
+        self.service = service
+        self.storage = service.storage
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="studentverse-server")
+
+    async def call(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def serve(self, host: str = SERVER_HOST, port: int = SERVER_PORT, ready=None):
+        server = await asyncio.start_server(self.handle_client, host, port, limit=SERVER_LINE_LIMIT)
+        if ready is not None:
+            ready(server.sockets[0].getsockname()[1])
+        async with server:
+            await server.serve_forever()
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        state = {"user_id": None, "token": None, "quiz": []}
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (ValueError, asyncio.LimitOverrunError):  # over SERVER_LINE_LIMIT; the stream can't resync
+                    writer.write(json.dumps({"ok": False, "error": "request too long"}).encode("utf-8") + b"\n")
+                    await writer.drain()
+                    break
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    handler = getattr(self, "op_" + str(request.get("op")), None)
+                    if handler is None:
+                        raise ValueError(f"unknown op {request.get('op')!r}")
+                    reply = {"ok": True, **(await handler(state, request))}
+                except (ValueError, KeyError, TypeError, PermissionError) as e:
+                    reply = {"ok": False, "error": str(e)}
+                except Exception as e:  # a failing op (sqlite3.Error, ...) ends the request, not the session
+                    traceback.print_exc()
+                    reply = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+                writer.write(json.dumps(reply).encode("utf-8") + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass  # client went away, or the server is shutting down
         finally:
-            conn.close()
+            writer.close()
+
+    @staticmethod
+    def user(state: dict) -> int:
+        if state["user_id"] is None:
+            raise PermissionError("not logged in")
+        return state["user_id"]
+
+    @staticmethod
+    def positive(req: dict, key: str, default: int) -> int:
+        """req[key] (or `default`) as an int that must be at least 1, e.g. a page size."""
+        value = int(req.get(key, default))
+        if value < 1:
+            raise ValueError(f"{key} must be positive")
+        return value
+
+    # Auth
+    async def op_register(self, state, req):
+        return {"created": await self.call(self.service.register, req["username"], req["password"])}
+
+    async def op_login(self, state, req):
+        result = await self.call(self.service.login, req["username"], req["password"])
+        if result is None:
+            raise PermissionError("invalid username or password")
+        state["user_id"], username, state["token"] = result
+        return {"user_id": state["user_id"], "username": username, "token": state["token"]}
+
+    async def op_resume(self, state, req):
+        result = await self.call(self.service.resume, req["token"])
+        if result is None:
+            raise PermissionError("session expired or revoked")
+        state["user_id"], state["token"] = result[0], req["token"]
+        return {"user_id": result[0], "username": result[1]}
+
+    async def op_logout(self, state, req):
+        if state["token"]:
+            await self.call(self.service.logout, state["token"])
+        state.update(user_id=None, token=None, quiz=[])
+        return {}
+
+    # Notes & plans
+    async def op_add_note(self, state, req):
+        await self.call(self.storage.add_note, self.user(state), str(req["note"]))
+        return {}
+
+    async def op_notes(self, state, req):
+        rows, cursor = await self.call(self.storage.get_notes_page, self.user(state),
+                                       self.positive(req, "limit", PAGE_SIZE), req.get("cursor"))
+        return {"notes": rows, "cursor": cursor}
+
+    async def op_search(self, state, req):
+        rows = await self.call(self.storage.search_notes, self.user(state), str(req["query"]),
+                               self.positive(req, "limit", PAGE_SIZE), int(req.get("offset", 0)))
+        return {"results": rows}
+
+    async def op_add_plan(self, state, req):
+        day, until = (datetime.date.fromisoformat(req[key]) if req.get(key) else None for key in ("date", "until"))
+        user_id = self.user(state)
+        await self.call(lambda: self.storage.add_plan(user_id, str(req["plan"]), plan_date=day,
+                                                      repeat=req.get("repeat"), until=until))
+        return {}
+
+    async def op_agenda(self, state, req):
+        """{"period": "this week"} or {"start": "YYYY-MM-DD", "end": "YYYY-MM-DD"}; at most `limit` entries."""
+        if req.get("start"):
+            start = datetime.date.fromisoformat(req["start"])
+            end = datetime.date.fromisoformat(req.get("end") or req["start"])
+        else:
+            start, end = agenda_window(req.get("period", "this week"))
+        agenda = self.storage.iter_agenda(self.user(state), start, end)
+        rows = await self.call(lambda: list(islice(agenda, self.positive(req, "limit", AGENDA_LIMIT))))
+        return {"agenda": [(day.isoformat(), plan, rule) for day, plan, rule in rows]}
+
+    async def op_plans(self, state, req):
+        rows, cursor = await self.call(self.storage.get_plans_page, self.user(state),
+                                       self.positive(req, "limit", PAGE_SIZE), req.get("cursor"))
+        return {"plans": rows, "cursor": cursor}
+
+    # Quiz & progress
+    async def op_quiz(self, state, req):
+        self.user(state)
+        state["quiz"] = await self.call(self.service.start_quiz, self.positive(req, "count", QUIZ_LENGTH),
+                                        req.get("topic"), req.get("difficulty"))
+        return {"questions": [{"id": q.id, "topic": q.topic, "difficulty": q.difficulty, "question": q.text}
+                              for q in state["quiz"]]}
+
+    async def op_answer(self, state, req):
+        if not state["quiz"]:
+            raise ValueError("no quiz in progress")
+        questions, state["quiz"] = state["quiz"], []
+        score, total, results = await self.call(self.service.finish_quiz, self.user(state),
+                                                questions, dict(req["answers"]))
+        return {"score": score, "total": total, "correct": results}
 
+    async def op_progress(self, state, req):
+        stats = await self.call(self.storage.get_progress, self.user(state))
+        weekly = await self.call(self.storage.get_weekly_progress, state["user_id"])
+        return {"stats": stats._asdict() if stats else None, "weekly": weekly}
 
-# ------------------ APP (business logic + UI) ------------------
+    async def op_leaderboard(self, state, req):
+        board = str(req.get("board", "best"))
+        if board not in LEADERBOARD_ORDER:
+            raise ValueError(f"unknown board {board!r}")
+        rows = await self.call(self.storage.get_leaderboard, board, self.positive(req, "k", LEADERBOARD_SIZE))
+        rank = await self.call(self.storage.get_rank, state["user_id"], board) if state["user_id"] else None
+        return {"board": rows, "rank": rank}
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+# ------------------ APP (console UI) ------------------
 
 class StudentVerse:
-    def __init__(self):
-        self.storage = Storage()
+    def __init__(self, db_path: str = DB_NAME, buffered_writes: bool = False,
+                 profiler: Optional[Profiler] = None, cache_size: int = HISTORY_CACHE_USERS):
+        self.hasher = HashingService()
+        self.storage = open_storage(db_path, hasher=self.hasher, buffered_writes=buffered_writes, profiler=profiler,
+                               cache_size=cache_size)
+        self.storage.prune_sessions()
+        self.service = Service(self.storage, self.hasher)
+        self.session_file = Path(db_path).with_suffix(".session")
+        self.session_token: Optional[str] = None
         self.current_user_id: Optional[int] = None
         self.current_username: Optional[str] = None
-        self.questions = [
-            ("What is 2 + 2?", "4"),
-            ("Capital of India?", "delhi"),
-            ("Which language is this project in?", "python"),
-        ]
 
     # BANNER
-    def banner(self):
-        print("=" * 50)
-        print("        STUDENTVERSE - LEGENDARY")
-        print("     Learn | Play | Plan | Grow")
-        print("=" * 50)
+    def banner(self) -> List[str]:
+        return [
+            "=" * 50,
+            "        STUDENTVERSE - LEGENDARY",
+            "     Learn | Play | Plan | Grow",
+            "=" * 50,
+        ]
+
+    def show(self, *lines: str):
+        """Draw a screen: the banner followed by `lines` (which may contain newlines)."""
+        screen.draw(self.banner() + "\n".join(lines).split("\n"))
+
+    # PAGING
+    def show_pages(self, title: str, fetch_page, render_row) -> int:
+        """
+        Print a history one page at a time. fetch_page(cursor) -> (rows, next_cursor).
+        Only the current page is held in memory. Returns the number of rows shown.
+        """
+        shown = 0
+        cursor = None
+        while True:
+            rows, cursor = fetch_page(cursor)
+            if rows and shown == 0:
+                print(f"\n--- {title} ---")
+            for row in rows:
+                print(render_row(row))
+            shown += len(rows)
+            if cursor is None:
+                return shown
+            if screen.input("-- Enter for more, q to stop: ").strip().lower() == "q":
+                return shown
 
     # AUTH
     def register(self):
-        clear()
-        self.banner()
-        print("📝 REGISTER")
+        self.show("📝 REGISTER")
         username = prompt_nonempty("Choose username: ").lower()
         # Use getpass for password so it won't echo on screen
         while True:
-            password = getpass.getpass("Choose password: ")
+            password = screen.getpass("Choose password: ")
             if not password:
                 print("Password cannot be empty.")
                 continue
-            password2 = getpass.getpass("Confirm password: ")
+            password2 = screen.getpass("Confirm password: ")
             if password != password2:
                 print("Passwords do not match. Try again.")
                 continue
             break
 
-        success = self.storage.create_user(username, password)
+        success = self.service.register(username, password)
         if success:
             print("✅ Registration successful!")
         else:
@@ -270,29 +2655,47 @@ class StudentVerse:
         pause()
 
     def login(self):
-        clear()
-        self.banner()
-        print("🔐 LOGIN")
+        self.show("🔐 LOGIN")
         username = prompt_nonempty("Username: ").lower()
-        password = getpass.getpass("Password: ")
-        user = self.storage.get_user(username)
-        if user is None:
+        password = screen.getpass("Password: ")
+        result = self.service.login(username, password)
+        if result is None:
             print("❌ Invalid username or password.")
             pause()
             return False
-        user_id, _, pw_salt, pw_hash = user
-        if verify_password(pw_salt, pw_hash, password):
-            self.current_user_id = user_id
-            self.current_username = username
-            print("✅ Login successful!")
-            pause()
-            return True
-        else:
-            print("❌ Invalid username or password.")
-            pause()
+        self.current_user_id, self.current_username, self.session_token = result
+        self.save_session()
+        print("✅ Login successful!")
+        pause()
+        return True
+
+    def save_session(self):
+        """Remember this login so the next run() resumes without a password."""
+        try:
+            fd = os.open(self.session_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                f.write(self.session_token)
+        except OSError:
+            pass  # no saved session; the user just logs in again next time
+
+    def resume_session(self) -> bool:
+        try:
+            token = self.session_file.read_text().strip()
+        except OSError:
             return False
+        user = self.service.resume(token)
+        if user is None:
+            self.session_file.unlink(missing_ok=True)
+            return False
+        self.session_token = token
+        self.current_user_id, self.current_username = user
+        return True
 
     def logout(self):
+        if self.session_token:
+            self.service.logout(self.session_token)
+            self.session_token = None
+            self.session_file.unlink(missing_ok=True)
         self.current_user_id = None
         self.current_username = None
         print("Logged out.")
@@ -300,19 +2703,28 @@ class StudentVerse:
 
     # QUIZ
     def quiz_zone(self):
-        clear()
-        self.banner()
-        print("🧠 QUIZ ZONE")
+        self.show("🧠 QUIZ ZONE")
+        topics = self.storage.get_question_topics()
+        print("Topics: 0. any  " + "  ".join(f"{i}. {t}" for i, t in enumerate(topics, start=1)))
+        pick = safe_int("Topic: ", 0, len(topics))
+        topic = topics[pick - 1] if pick else None
+        print("Difficulty: 0. any  " + "  ".join(f"{k}. {v}" for k, v in DIFFICULTIES.items()))
+        difficulty = safe_int("Difficulty: ", 0, max(DIFFICULTIES)) or None
+        count = safe_int(f"How many questions? (1-50, usually {QUIZ_LENGTH}): ", 1, 50)
         score = 0
-        total = len(self.questions)
-        for q, ans in self.questions:
-            print("\nQ:", q)
-            user_ans = prompt_nonempty("Answer: ").lower()
-            if user_ans == ans:
+        total = 0
+        for question in self.storage.sample_questions(count, topic, difficulty):
+            total += 1
+            print(f"\nQ{total} [{question.topic}, {DIFFICULTIES.get(question.difficulty, '?')}]:", question.text)
+            if question.check(prompt_nonempty("Answer: ")):
                 print("✅ Correct!")
                 score += 1
             else:
-                print("❌ Wrong! (Expected: {})".format(ans))
+                print("❌ Wrong! (Expected: {})".format(question.answer))
+        if total == 0:
+            print("No questions match that topic and difficulty.")
+            pause()
+            return
         print("\n🏆 Your Score:", score, "/", total)
         if self.current_user_id:
             self.storage.add_quiz_score(self.current_user_id, score, total)
@@ -320,17 +2732,14 @@ class StudentVerse:
 
     # GAMES
     def games_zone(self):
-        clear()
-        self.banner()
-        print("🎮 GAMES ZONE")
-        print("1. Number Guess")
-        print("2. Back")
+        self.show("🎮 GAMES ZONE",
+                  "1. Number Guess",
+                  "2. Back")
         choice = prompt_choice("Choose: ", ["1", "2"])
         if choice == "1":
             self.number_guess()
 
     def number_guess(self):
-        import random
         secret = random.randint(1, 10)
         tries = 3
         print("Guess the secret number between 1 and 10. You have 3 tries.")
@@ -348,13 +2757,12 @@ class StudentVerse:
 
     # NOTES
     def notes_manager(self):
-        clear()
-        self.banner()
-        print("📝 NOTES")
-        print("1. Write Note")
-        print("2. View Notes")
-        print("3. Back")
-        choice = prompt_choice("Choose: ", ["1", "2", "3"])
+        self.show("📝 NOTES",
+                  "1. Write Note",
+                  "2. View Notes",
+                  "3. Search Notes",
+                  "4. Back")
+        choice = prompt_choice("Choose: ", ["1", "2", "3", "4"])
         if choice == "1":
             note = prompt_nonempty("Write your note:\n")
             if self.current_user_id:
@@ -362,60 +2770,139 @@ class StudentVerse:
                 print("✅ Saved!")
         elif choice == "2":
             if self.current_user_id:
-                notes = self.storage.get_notes_for_user(self.current_user_id)
-                if not notes:
+                user_id = self.current_user_id
+                shown = self.show_pages("NOTES (most recent first)",
+                                        lambda cursor: self.storage.get_notes_page(user_id, cursor=cursor),
+                                        lambda row: f"[{row[1]}] {row[0]}")
+                if not shown:
                     print("No notes found.")
-                else:
-                    print("\n--- NOTES (most recent first) ---")
-                    for note, created_at in notes:
-                        print(f"[{created_at}] {note}")
+            else:
+                print("No user logged in.")
+        elif choice == "3":
+            if self.current_user_id:
+                user_id = self.current_user_id
+                query = prompt_nonempty("Search for: ")
+                highlight = ("\033[1;33m", "\033[0m") if sys.stdout.isatty() else ("[", "]")
+
+                def fetch_page(offset):
+                    offset = offset or 0
+                    rows = self.storage.search_notes(user_id, query, limit=PAGE_SIZE + 1,
+                                                     offset=offset, highlight=highlight)
+                    if len(rows) > PAGE_SIZE:
+                        return rows[:PAGE_SIZE], offset + PAGE_SIZE
+                    return rows, None
+
+                shown = self.show_pages(f"RESULTS FOR '{query}' (best match first)", fetch_page,
+                                        lambda row: f"[{row[1]}] {row[0]}")
+                if not shown:
+                    print("No matching notes.")
             else:
                 print("No user logged in.")
         pause()
 
     # PLANNER
     def study_planner(self):
-        clear()
-        self.banner()
-        print("📅 STUDY PLANNER")
-        plan = prompt_nonempty("Enter today's study plan:\n")
-        if self.current_user_id:
-            self.storage.add_plan(self.current_user_id, plan)
+        self.show("📅 STUDY PLANNER",
+                  "1. Add Plan",
+                  "2. This Week",
+                  "3. Next 30 Days",
+                  "4. All Plans",
+                  "5. Back")
+        choice = prompt_choice("Choose: ", ["1", "2", "3", "4", "5"])
+        if choice == "5":
+            return
+        if not self.current_user_id:
+            print("No user logged in.")
+        elif choice == "1":
+            plan = prompt_nonempty("Enter your study plan:\n")
+            day = prompt_date("Date (YYYY-MM-DD, today, tomorrow; blank for none): ")
+            repeat, until = None, None
+            if day is not None:
+                repeat = prompt_choice(f"Repeat ({' / '.join(('none',) + REPEAT_RULES)}): ",
+                                       ["", "none", *REPEAT_RULES]) or "none"
+                repeat = None if repeat == "none" else repeat
+                if repeat is not None:
+                    until = prompt_date("Repeat until (blank for no end): ")
+            self.storage.add_plan(self.current_user_id, plan, plan_date=day, repeat=repeat, until=until)
             print("✅ Plan saved!")
+        elif choice in ("2", "3"):
+            user_id = self.current_user_id
+            period = "this week" if choice == "2" else "next 30 days"
+            start, end = agenda_window(period)
+
+            def fetch_page(agenda):
+                agenda = agenda or self.storage.iter_agenda(user_id, start, end)
+                rows = list(islice(agenda, PAGE_SIZE + 1))
+                if len(rows) > PAGE_SIZE:
+                    return rows[:PAGE_SIZE], chain(rows[PAGE_SIZE:], agenda)
+                return rows, None
+
+            shown = self.show_pages(f"{period.upper()} ({start:%a %d %b} - {end:%a %d %b})", fetch_page,
+                                    lambda row: f"{row[0]:%a %Y-%m-%d}  {row[1]}" + (f"  ({row[2]})" if row[2] else ""))
+            if not shown:
+                print("Nothing planned.")
+        else:
+            user_id = self.current_user_id
+            shown = self.show_pages("PLANS (most recent first)",
+                                    lambda cursor: self.storage.get_plans_page(user_id, cursor=cursor),
+                                    lambda row: f"[{row[1]}] {row[0]}")
+            if not shown:
+                print("No plans found.")
         pause()
 
     # PROGRESS
     def progress_tracker(self):
-        clear()
-        self.banner()
-        print("📊 PROGRESS")
+        self.show("📊 PROGRESS")
         if self.current_user_id:
-            scores = self.storage.get_quiz_scores_for_user(self.current_user_id)
-            if not scores:
+            user_id = self.current_user_id
+            stats = self.storage.get_progress(user_id)
+            if stats is None:
                 print("No quiz progress yet.")
             else:
-                print("\n--- QUIZ SCORES (most recent first) ---")
-                for score, total, created_at in scores:
-                    print(f"[{created_at}] {score}/{total}")
+                print(f"\nAttempts: {stats.attempts}   Average: {stats.avg_pct:.1f}%   "
+                      f"Best: {stats.best_score}/{stats.best_total} ({stats.best_pct:.0f}%)")
+                print(f"Last: {stats.last_pct:.0f}% on {stats.last_at}   "
+                      f"Recent trend: {stats.trend} ({stats.trend_pct:.1f}%)")
+                print("\n--- WEEKLY ---")
+                for week, attempts, avg_pct, best_pct in self.storage.get_weekly_progress(user_id):
+                    print(f"{week}: {attempts} attempt(s), avg {avg_pct:.1f}%, best {best_pct:.0f}%")
+                if screen.input("\nShow every attempt? (y/N): ").strip().lower() == "y":
+                    self.show_pages("QUIZ SCORES (most recent first)",
+                                    lambda cursor: self.storage.get_quiz_scores_page(user_id, cursor=cursor),
+                                    lambda row: f"[{row[2]}] {row[0]}/{row[1]}")
         else:
             print("No user logged in.")
         pause()
 
+    # LEADERBOARD
+    def leaderboard(self):
+        self.show("🏅 LEADERBOARD")
+        for board, title in (("best", "BEST SCORE"), ("average", f"AVERAGE (min {LEADERBOARD_MIN_ATTEMPTS} attempts)")):
+            print(f"\n--- {title} ---")
+            rows = self.storage.get_leaderboard(board)
+            if not rows:
+                print("No scores yet.")
+            for position, (user_id, username, pct, attempts) in enumerate(rows, start=1):
+                marker = " <- you" if user_id == self.current_user_id else ""
+                print(f"{position:>3}. {username:<20} {pct:5.1f}%  ({attempts} attempts){marker}")
+            if self.current_user_id:
+                rank = self.storage.get_rank(self.current_user_id, board)
+                print(f"Your rank: {rank if rank else '-'}")
+        pause()
+
     # MAIN MENU
     def main_menu(self):
         while self.current_user_id:
-            clear()
-            self.banner()
-            print("Logged in as:", self.current_username)
-            print("""
+            self.show(f"Logged in as: {self.current_username}", """
 1. Quiz Zone
 2. Games Zone
 3. Notes Manager
 4. Study Planner
 5. Progress Tracker
-6. Logout
+6. Leaderboard
+7. Logout
 """)
-            choice = prompt_choice("Choose: ", ["1", "2", "3", "4", "5", "6"])
+            choice = prompt_choice("Choose: ", ["1", "2", "3", "4", "5", "6", "7"])
             if choice == "1":
                 self.quiz_zone()
             elif choice == "2":
@@ -427,15 +2914,21 @@ class StudentVerse:
             elif choice == "5":
                 self.progress_tracker()
             elif choice == "6":
+                self.leaderboard()
+            elif choice == "7":
                 self.logout()
 
     # START LOOP
     def run(self):
+        with screen.installed():
+            self._run()
+
+    def _run(self):
         try:
+            if self.resume_session():
+                self.main_menu()
             while True:
-                clear()
-                self.banner()
-                print("""
+                self.show("""
 1. Login
 2. Register
 3. Exit
@@ -454,9 +2947,109 @@ class StudentVerse:
         except Exception as e:
             print("An unexpected error occurred:", e)
         finally:
+            self.hasher.shutdown()  # waits for background rehashes, which still write to storage
+            self.storage.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="StudentVerse - Learn | Play | Plan | Grow")
+    parser.add_argument("--db", default=DB_NAME, help="database file (default: %(default)s)")
+    parser.add_argument("--buffered-writes", action="store_true",
+                        help="group-commit notes, plans and scores from a background thread")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="read notes, plans and scores from the database every time")
+    parser.add_argument("--profile", action="store_true",
+                        help=f"time Storage calls and SQL statements, report on exit (or set {PROFILE_ENV}=1)")
+    parser.add_argument("--slow-ms", type=float, default=None,
+                        help=f"slow-query threshold in ms (default {SLOW_QUERY_MS:g}, or {SLOW_MS_ENV})")
+    parser.add_argument("--slow-log", default=None,
+                        help=f"slow-query log file (default {SLOW_QUERY_LOG}, or {SLOW_LOG_ENV})")
+    commands = parser.add_subparsers(dest="command")
+    calibrate = commands.add_parser("calibrate", help="pick password hash parameters for a target verify time")
+    calibrate.add_argument("--target-ms", type=float, default=250.0, help="verify latency to aim for")
+    calibrate.add_argument("--algorithm", choices=["pbkdf2_sha256", "scrypt"], default="pbkdf2_sha256")
+    calibrate.add_argument("--dry-run", action="store_true", help="print the parameters without saving them")
+    export = commands.add_parser("export", help="stream users, notes, plans and quiz scores to files")
+    export.add_argument("directory", type=Path)
+    export.add_argument("--format", choices=["jsonl", "csv"], default="jsonl")
+    export.add_argument("--gzip", action="store_true", help="compress the output files")
+    export.add_argument("--tables", nargs="+", choices=list(EXPORT_TABLES), default=list(EXPORT_TABLES))
+    import_ = commands.add_parser("import", help="load files written by export (CSV/JSONL, optionally .gz)")
+    import_.add_argument("directory", type=Path)
+    import_.add_argument("--tables", nargs="+", choices=list(EXPORT_TABLES), default=list(EXPORT_TABLES))
+    questions = commands.add_parser("questions", help="add questions from a CSV/JSONL file to the question bank")
+    questions.add_argument("file", type=Path)
+    archive = commands.add_parser("archive", help="compress large notes and move old ones to the archive database")
+    archive.add_argument("--days", type=int, default=ARCHIVE_DAYS, help="archive notes older than this")
+    reshard_ = commands.add_parser("reshard", help="offline: spread users over N shard files (1 = single file)")
+    reshard_.add_argument("shards", type=int)
+    serve = commands.add_parser("serve", help="serve many users at once over a JSON-lines TCP protocol")
+    serve.add_argument("--host", default=SERVER_HOST)
+    serve.add_argument("--port", type=int, default=SERVER_PORT)
+    args = parser.parse_args(argv)
+
+    profiler = Profiler.from_env()
+    if args.profile and profiler is None:
+        profiler = Profiler()
+    if profiler is not None:
+        if args.slow_ms is not None:
+            profiler.slow = args.slow_ms / 1000
+        if args.slow_log is not None:
+            profiler.slow_log = args.slow_log
+        atexit.register(profiler.report)
+    cache_size = 0 if args.no_cache else HISTORY_CACHE_USERS
+
+    if args.command in ("export", "import", "questions", "archive"):
+        storage = open_storage(args.db, profiler=profiler)
+        try:
+            if args.command == "export":
+                export_data(storage, args.directory, args.format, args.gzip, args.tables)
+            elif args.command == "import":
+                import_data(storage, args.directory, args.tables)
+            elif args.command == "archive":
+                archive_data(storage, args.days)
+            else:
+                load_question_bank(storage, args.file)
+        finally:
+            storage.close()
+        return
+
+    if args.command == "serve":
+        hasher = HashingService()
+        storage = open_storage(args.db, hasher=hasher, buffered_writes=args.buffered_writes, profiler=profiler,
+                          cache_size=cache_size)
+        storage.prune_sessions()
+        server = Server(Service(storage, hasher))
+        try:
+            asyncio.run(server.serve(args.host, args.port,
+                                     ready=lambda port: print(f"StudentVerse listening on {args.host}:{port}")))
+        except KeyboardInterrupt:
             pass
+        finally:
+            server.close()
+            hasher.shutdown()  # waits for background rehashes, which still write to storage
+            storage.close()
+        return
+
+    if args.command == "reshard":
+        reshard(args.db, args.shards)
+        return
+
+    if args.command == "calibrate":
+        params = calibrate_hash_params(args.target_ms, args.algorithm)
+        start = time.perf_counter()
+        hash_password("calibration", None, params)
+        print(f"{params}  ({(time.perf_counter() - start) * 1000:.0f} ms per verify)")
+        if not args.dry_run:
+            storage = open_storage(args.db, profiler=profiler)
+            storage.set_hash_params(params)
+            storage.close()
+            print(f"Saved to {args.db}; existing users are rehashed on their next login.")
+        return
+
+    app = StudentVerse(args.db, buffered_writes=args.buffered_writes, profiler=profiler, cache_size=cache_size)
+    app.run()
 
 
 if __name__ == "__main__":
-    app = StudentVerse()
-    app.run()
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+# ==================================================
+# STUDENTVERSE - BENCHMARKS
+# Run: python studentverse_bench.py <benchmark> [options]
+# Every benchmark works on a throwaway database in a temp directory.
+# ==================================================
+
+import os
+import sys
+import json
+import random
+import time
+import asyncio
+import sqlite3
+import argparse
+import datetime
+import tempfile
+import tracemalloc
+import multiprocessing
+from itertools import islice
+from pathlib import Path
+
+from studentverse import (REPEAT_RULES, HashingService, Server, Service, Storage, archive_data, hash_password, iso_in,
+                          agenda_window, now_iso, open_storage, reshard, verify_password)
+
+
+# ------------------ HELPERS ------------------
+
+def percentile(sorted_values, pct: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))]
+
+
+def timed(label: str, ops: int, fn):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(f"  {label:<36} {ops:>8} ops  {elapsed:8.3f}s  {ops / elapsed:>12,.0f} ops/sec")
+    return elapsed
+
+
+class PerCallStorage:
+    """The old Storage access pattern: one fresh connection per call, closed afterwards."""
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+
+    def _connect(self):
+        return sqlite3.connect(str(self.db_path), timeout=10, isolation_level=None)
+
+    def add_note(self, user_id: int, note: str):
+        conn = self._connect()
+        try:
+            conn.execute("INSERT INTO notes (user_id, note, created_at) VALUES (?, ?, ?)",
+                         (user_id, note, now_iso()))
+        finally:
+            conn.close()
+
+    def get_notes_for_user(self, user_id: int):
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT note, created_at FROM notes WHERE user_id = ? ORDER BY created_at DESC",
+                                (user_id,)).fetchall()
+        finally:
+            conn.close()
+
+
+# ------------------ BENCHMARKS ------------------
+
+def bench_pool(args):
+    """add_note / get_notes_for_user ops/sec: per-call connections vs pooled Storage."""
+    with tempfile.TemporaryDirectory() as tmp:
+        print("Per-call connections (before):")
+        old_db = Path(tmp) / "percall.db"
+        Storage(str(old_db)).close()  # create schema
+        # the old code never enabled WAL, so measure it in rollback-journal mode
+        sqlite3.connect(str(old_db)).execute("PRAGMA journal_mode=DELETE").close()
+        old = PerCallStorage(old_db)
+        timed("add_note", args.ops, lambda: [old.add_note(1, f"note {i}") for i in range(args.ops)])
+        timed("get_notes_for_user", args.reads, lambda: [old.get_notes_for_user(1) for _ in range(args.reads)])
+
+        print("Pooled connections + WAL (after):")
+        storage = Storage(str(Path(tmp) / "pooled.db"), cache_size=0)
+        try:
+            timed("add_note", args.ops, lambda: [storage.add_note(1, f"note {i}") for i in range(args.ops)])
+            timed("get_notes_for_user", args.reads, lambda: [storage.get_notes_for_user(1) for _ in range(args.reads)])
+        finally:
+            storage.close()
+
+
+def bench_search(args):
+    """search_notes latency for one user with --ops notes (other users' notes mixed in)."""
+    words = ["python", "sqlite", "loops", "classes", "recursion", "exam", "revision", "physics", "algebra", "essay"]
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = Storage(str(Path(tmp) / "search.db"))
+        try:
+            rows = ((i % 4, " ".join(words[(i * k) % len(words)] for k in range(1, 6)) + f" item{i}", now_iso())
+                    for i in range(args.ops * 4))
+            with storage._write() as conn:
+                conn.execute("BEGIN")
+                conn.executemany("INSERT INTO notes (user_id, note, created_at) VALUES (?, ?, ?)", rows)
+                conn.execute("COMMIT")
+            assert storage.search_notes(1, "1") == []  # terms match note text only, never the user_id column
+            for query in ("python", "recursion exam", "rev*", f"item{args.ops}"):
+                timed(f"search_notes {query!r}", args.reads,
+                      lambda: [storage.search_notes(0, query) for _ in range(args.reads)])
+        finally:
+            storage.close()
+
+
+def bench_hashing(args):
+    """Password verifications (logins) per second: inline vs HashingService at 1..2x cores workers."""
+    logins = args.reads
+    salt_hex, hash_hex = hash_password("correct horse")
+    timed("inline verify_password", logins,
+          lambda: [verify_password(salt_hex, hash_hex, "correct horse") for _ in range(logins)])
+    workers = 1
+    while workers <= 2 * (os.cpu_count() or 1):
+        hasher = HashingService(workers=workers)
+        try:
+            hasher.verify_password(salt_hex, hash_hex, "warm up").result()  # start the worker processes
+            timed(f"HashingService workers={workers}", logins,
+                  lambda: [f.result() for f in [hasher.verify_password(salt_hex, hash_hex, "correct horse")
+                                                for _ in range(logins)]])
+        finally:
+            hasher.shutdown()
+        workers *= 2
+
+
+def bench_buffer(args):
+    """add_note/add_plan/add_quiz_score inserts per second with the group-commit buffer off and on."""
+    for buffered in (False, True):
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = Storage(str(Path(tmp) / "buffer.db"), buffered_writes=buffered)
+            committed = []
+
+            def run():
+                for i in range(args.ops):
+                    storage.add_note(1, f"note {i}", committed.append)
+                    storage.add_plan(1, f"plan {i}", committed.append)
+                    storage.add_quiz_score(1, i % 4, 3, committed.append)
+                storage.flush()
+
+            try:
+                timed(f"inserts, buffered_writes={buffered}", args.ops * 3, run)
+                assert len(committed) == args.ops * 3 and not any(committed)
+            finally:
+                storage.close()
+
+
+def bench_cache(args):
+    """Repeated history reads (whole list and first page) with the history cache off and on."""
+    for cache_size in (0, 64):
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = Storage(str(Path(tmp) / "cache.db"), cache_size=cache_size)
+            try:
+                for i in range(args.ops):
+                    storage.add_note(1 + i % 16, f"note {i}")
+                label = "on" if cache_size else "off"
+                timed(f"get_notes_for_user, cache {label}", args.reads,
+                      lambda: [storage.get_notes_for_user(1 + i % 16) for i in range(args.reads)])
+                timed(f"get_notes_page, cache {label}", args.reads,
+                      lambda: [storage.get_notes_page(1 + i % 16) for i in range(args.reads)])
+                timed(f"add_note + get_notes_page, cache {label}", args.reads,
+                      lambda: [(storage.add_note(1, "again"), storage.get_notes_page(1)) for _ in range(args.reads)])
+                if cache_size:
+                    print(f"  {storage.cache_stats()}")
+            finally:
+                storage.close()
+
+
+def bench_archive(args):
+    """
+    Space and hot-tier read latency before and after `archive` (compress + move notes older
+    than 180 days) on --ops * 50 plain notes spread over two years, a third of them long.
+    """
+    users, notes = max(1, args.ops // 20), args.ops * 50
+    words = ["python", "sqlite", "loops", "classes", "recursion", "exam", "revision", "physics", "algebra", "essay"]
+
+    vocabulary = words + ["".join(chr(97 + (n * k * 7) % 26) for k in range(2 + n % 9)) for n in range(3000)]
+
+    def body(i: int) -> str:
+        rng = random.Random(i)
+        return " ".join(rng.choice(vocabulary) for _ in range(400 if i % 3 == 0 else 12))
+
+    def latency(storage, label: str):
+        samples = []
+        for i in range(args.reads):
+            start = time.perf_counter()
+            storage.get_notes_page(1 + (i * 7919) % users)
+            samples.append(time.perf_counter() - start)
+        samples.sort()
+        print(f"  {label:<36} p50 {percentile(samples, 50) * 1e6:8.1f} us   p99 {percentile(samples, 99) * 1e6:8.1f} us")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = Storage(str(Path(tmp) / "archive.db"), cache_size=0)
+        try:
+            with storage._write() as conn:
+                conn.execute("BEGIN")
+                conn.executemany("INSERT INTO notes (user_id, note, created_at) VALUES (?, ?, ?)",
+                                 ((1 + i % users, body(i), iso_in(minutes=-(notes - i) * 730 * 24 * 60 // notes))
+                                  for i in range(notes)))
+                conn.execute("COMMIT")
+                conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            latency(storage, "get_notes_page, before")
+            archive_data(storage, 180)
+            latency(storage, "get_notes_page, after")
+            timed("search_notes across tiers", args.reads,
+                  lambda: [storage.search_notes(1 + i % users, "recursion") for i in range(args.reads)])
+        finally:
+            storage.close()
+
+
+def shard_writer(db_path: str, users: int, ops: int, offset: int, barrier):
+    storage = open_storage(db_path, cache_size=0)
+    try:
+        barrier.wait()
+        for i in range(ops):
+            storage.add_note(1 + (offset + i) % users, f"note {i} from writer {offset}")
+    finally:
+        storage.close()
+
+
+def bench_shards(args):
+    """Concurrent add_note throughput from --writers processes with 1, 2, 4 and 8 shards."""
+    users = args.writers * 16
+    for shards in (1, 2, 4, 8):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = str(Path(tmp) / "shards.db")
+            with open(os.devnull, "w") as quiet:
+                reshard(db_path, shards, out=quiet)
+            storage = open_storage(db_path)
+            storage.set_hash_params("pbkdf2_sha256:1000")
+            for i in range(users):
+                storage.create_user(f"user{i}", "secret")
+            storage.close()
+            barrier = multiprocessing.Barrier(args.writers + 1)
+            writers = [multiprocessing.Process(target=shard_writer, args=(db_path, users, args.ops, n * 7, barrier))
+                       for n in range(args.writers)]
+            for writer in writers:
+                writer.start()
+
+            def run():
+                barrier.wait()
+                for writer in writers:
+                    writer.join()
+
+            timed(f"add_note, {args.writers} writers, {shards} shard(s)", args.writers * args.ops, run)
+
+
+def bench_agenda(args):
+    """
+    Agenda queries for a user with --ops * 5 one-off plans over ten years and 20 recurring
+    plans (other users' plans mixed in): short windows, the first page of a ten-year view,
+    and the whole ten years with peak Python memory.
+    """
+    today = datetime.date.today()
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = Storage(str(Path(tmp) / "agenda.db"), cache_size=0)
+        try:
+            with storage._write() as conn:
+                conn.execute("BEGIN")
+                conn.executemany("INSERT INTO plans (user_id, plan, created_at, plan_date) VALUES (?, ?, ?, ?)",
+                                 ((1 + i % 4, f"plan {i}", now_iso(), (today + datetime.timedelta(days=(i * 7) % 3650)).isoformat())
+                                  for i in range(args.ops * 20)))
+                conn.execute("COMMIT")
+            for i in range(20):
+                storage.add_plan(1, f"routine {i}", plan_date=today - datetime.timedelta(days=400 + i),
+                                 repeat=REPEAT_RULES[i % len(REPEAT_RULES)])
+            for period in ("this week", "next 30 days"):
+                start, end = agenda_window(period)
+                timed(f"iter_agenda {period!r}", args.reads,
+                      lambda: [list(storage.iter_agenda(1, start, end)) for _ in range(args.reads)])
+            decade = (today, today + datetime.timedelta(days=3650))
+            timed("iter_agenda ten years, first 10", args.reads,
+                  lambda: [list(islice(storage.iter_agenda(1, *decade), 10)) for _ in range(args.reads)])
+            tracemalloc.start()
+            count = [0]
+            timed("iter_agenda ten years, everything", 1,
+                  lambda: count.__setitem__(0, sum(1 for _ in storage.iter_agenda(1, *decade))))
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"  {count[0]:,} entries, peak {peak / 1024:,.0f} KiB of Python memory")
+        finally:
+            storage.close()
+
+
+def bench_leaderboard(args):
+    """Leaderboard and rank latency over --ops * 500 quiz scores spread across --ops * 10 users."""
+    users, scores = args.ops * 10, args.ops * 500
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = Storage(str(Path(tmp) / "leaderboard.db"))
+        try:
+            with storage._write() as conn:
+                conn.execute("BEGIN")
+                conn.executemany("INSERT INTO users (username, pw_salt, pw_hash, created_at) VALUES (?, '', '', ?)",
+                                 ((f"user{i}", now_iso()) for i in range(users)))
+                conn.executemany("INSERT INTO quiz_scores (user_id, score, total, created_at) VALUES (?, ?, 10, ?)",
+                                 ((1 + (i * 7919) % users, (i * 31) % 11, now_iso()) for i in range(scores)))
+                conn.execute("COMMIT")
+            for board in ("best", "average"):
+                timed(f"get_leaderboard {board} (uncached)", args.reads,
+                      lambda: [(storage._leaderboards.clear(), storage.get_leaderboard(board)) for _ in range(args.reads)])
+                timed(f"get_leaderboard {board} (cached)", args.reads,
+                      lambda: [storage.get_leaderboard(board) for _ in range(args.reads)])
+                timed(f"get_rank {board}", args.reads,
+                      lambda: [storage.get_rank(1 + i % users, board) for i in range(args.reads)])
+        finally:
+            storage.close()
+
+
+def bench_load(args):
+    """
+    Local load generator for `studentverse.py serve`: --concurrency clients run --sessions
+    sessions in total (login once, then resume by token; note, notes, quiz, answer, progress,
+    leaderboard) against an in-process server. Reports sessions/sec and request latency.
+    """
+    async def run():
+        with tempfile.TemporaryDirectory() as tmp:
+            hasher = HashingService()
+            storage = Storage(str(Path(tmp) / "load.db"), hasher=hasher)
+            if args.hash_params:
+                storage.set_hash_params(args.hash_params)
+            server = Server(Service(storage, hasher))
+            ready = asyncio.get_running_loop().create_future()
+            serving = asyncio.ensure_future(server.serve("127.0.0.1", 0, ready=ready.set_result))
+            port = await ready
+            latencies = []
+            remaining = [args.sessions]
+
+            async def client(n: int):
+                username, token = f"loaduser{n}", None
+                while remaining[0] > 0:
+                    remaining[0] -= 1
+                    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+
+                    async def request(**req):
+                        start = time.perf_counter()
+                        writer.write(json.dumps(req).encode() + b"\n")
+                        await writer.drain()
+                        reply = json.loads(await reader.readline())
+                        latencies.append(time.perf_counter() - start)
+                        return reply
+
+                    if token is None or not (await request(op="resume", token=token))["ok"]:
+                        await request(op="register", username=username, password="secret")
+                        token = (await request(op="login", username=username, password="secret"))["token"]
+                    await request(op="add_note", note=f"note from {username}")
+                    await request(op="notes")
+                    quiz = await request(op="quiz", count=3)
+                    await request(op="answer", answers={q["id"]: "4" for q in quiz["questions"]})
+                    await request(op="progress")
+                    await request(op="leaderboard")
+                    writer.close()
+                    await writer.wait_closed()
+
+            start = time.perf_counter()
+            await asyncio.gather(*(client(n) for n in range(args.concurrency)))
+            elapsed = time.perf_counter() - start
+            serving.cancel()
+            server.close()
+            storage.close()
+            hasher.shutdown()
+            latencies.sort()
+            print(f"  {args.sessions} sessions, {args.concurrency} concurrent clients, {len(latencies)} requests "
+                  f"in {elapsed:.2f}s")
+            print(f"  {args.sessions / elapsed:,.1f} sessions/sec   request latency "
+                  f"p50 {percentile(latencies, 50) * 1000:.1f} ms   p99 {percentile(latencies, 99) * 1000:.1f} ms")
+
+    asyncio.run(run())
+
+
+BENCHMARKS = {
+    "agenda": bench_agenda,
+    "pool": bench_pool,
+    "search": bench_search,
+    "shards": bench_shards,
+    "hashing": bench_hashing,
+    "archive": bench_archive,
+    "buffer": bench_buffer,
+    "cache": bench_cache,
+    "leaderboard": bench_leaderboard,
+    "load": bench_load,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="StudentVerse benchmarks")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--ops", type=int, default=2000, help="number of write operations")
+    parser.add_argument("--reads", type=int, default=500, help="number of read operations")
+    parser.add_argument("--sessions", type=int, default=500, help="load: total client sessions")
+    parser.add_argument("--concurrency", type=int, default=50, help="load: simultaneous clients")
+    parser.add_argument("--writers", type=int, default=8, help="shards: concurrent writer processes")
+    parser.add_argument("--hash-params", help="load: password hash parameters, e.g. pbkdf2_sha256:1000")
+    args = parser.parse_args(argv)
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())